@@ -3,124 +3,730 @@
 '''
 Run an interactive QA session with the news articles using the Groq LLM API and retrieval augmented generation (RAG).
 
-New articles can be added to the database with the --add_url parameter,
+New articles can be added to the database with the --add_url parameter (which accepts any number of urls)
+or the --url_file parameter,
 and the path to the database can be changed with the --db parameter.
+To answer queries over HTTP instead, run `python3 -m ragnews serve` (see ragnews/server.py).
 '''
 
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, urldefrag, urljoin, quote
+import collections
+import contextlib
+import argparse
 import datetime
+import hashlib
+import queue
+import math
 import logging
 import re
 import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
 
-from groq import Groq
-import groq
 import os
 
-from bs4 import BeautifulSoup
-import requests
-#import ragnewsmetahtml
+from .monitoring import metrics, profiled
+from .llm import (
+    get_backend,
+    set_backend,
+    llm_cache,
+    run_llm,
+    run_llm_stream,
+    summarize_text,
+    translate_text,
+    extract_keywords,
+    _estimate_tokens,
+    _get_session,
+    )
+
+# groq, requests, and numpy are slow to import,
+# so they are imported inside of the functions that use them;
+# this keeps short command line invocations (and importing ragnews) fast
 
 
 ################################################################################
-# LLM functions
+# helper functions
 ################################################################################
 
-client = Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
-)
+def _logsql(sql):
+    rex = re.compile(r'\s+')
+    sql_dewhite = rex.sub(' ', sql).strip()
+    logging.debug(f'SQL: {sql_dewhite}')
 
 
-def run_llm(system, user, model='llama-3.1-70b-versatile', seed=None):
+def _catch_errors(func):
     '''
-    This is a helper function for all the uses of LLMs in this file.
+    This function is intended to be used as a decorator.
+    It traps whatever errors the input function raises and logs the errors.
+    We use this decorator on the add_urls method below to ensure that a webcrawl continues even if there are errors.
+    The errors are also counted (by the function name and error type) in the ragnews_errors_total metric.
     '''
-    chat_completion = client.chat.completions.create(
-        temperature = .5,
-        messages=[
-            {
-                'role': 'system',
-                'content': system,
-            },
-            {
-                "role": "user",
-                "content": user,
-            }
-        ],
-        model=model,
-        seed=seed if seed is not None else None
-        #seed allows for deterministic results
-    )
-    return chat_completion.choices[0].message.content
+    def inner_function(*args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc('ragnews_errors_total', where=func.__name__, type=type(e).__name__)
+            logging.error(str(e))
+    return inner_function
 
 
-def summarize_text(text, seed=None):
-    system = 'Summarize the input text below.  Limit the summary to 1 paragraph.  Use an advanced reading level similar to the input text, and ensure that all people, places, and other proper and dates nouns are included in the summary.  The summary should be in English.'
-    return run_llm(system, text, seed=seed)
+################################################################################
+# crawling
+################################################################################
+
+def _normalize_url(url):
+    '''
+    Return a canonical form of the url that is suitable for deduplication.
 
+    >>> _normalize_url('www.example.com/a#section')
+    'https://www.example.com/a'
+    >>> _normalize_url('HTTPS://Example.com/b')
+    'https://example.com/b'
+    '''
+    url, _ = urldefrag(url.strip())
+    if '://' not in url:
+        url = 'https://' + url
+    parsed = urlparse(url)
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower()).geturl()
 
-def translate_text(text):
-    system = 'You are a professional translator working for the United Nations.  The following document is an important news article that needs to be translated into English.  Provide a professional translation.'
-    return run_llm(system, text)
 
+def _content_hash(text):
+    '''
+    Return a hash of the text that is used to detect changed articles, or None if there is no text.
 
-def extract_keywords(text, seed=None):
-    r'''
-    This is a helper function for RAG.
-    Given an input text,
-    this function extracts the keywords that will be used to perform the search for articles that will be used in RAG.
+    >>> _content_hash('hello world')
+    '2aae6c35c94fcfb415dbe95f408b9ce91ee846ed'
+    >>> _content_hash(None) is None
+    True
+    '''
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
-    >>> extract_keywords('Who is the current democratic presidential nominee?', seed=0)
-    'Joe candidate nominee presidential Democrat election primary TBD voting politics'
-    >>> extract_keywords('What is the policy position of Trump related to illegal Mexican immigrants?', seed=0)
-    'Trump Mexican immigrants policy position illegal border control deportation walls'
 
-    Note that the examples above are passing in a seed value for deterministic results.
-    In production, you probably do not want to specify the seed.
+def _download(url, validators=None):
     '''
+    Download the url and return a dictionary describing the downloaded page.
+    The dictionary's url has had a missing schema fixed.
 
-    system = '''
-    You are an advanced assistant specializing in text analysis. 
-    Your task is to extract the most important and relevant keywords from the following text.  
-    The keywords should capture the core topics and entities mentioned in the text.
-    Responses should come in the format of 'keyword keyword keyword keyword'. 
-    Output exactly 10 keywords. 
-    Output only keywords, nothing more. 
-    Do not prefice the keywords with "here are the keywords," and do not explain how the keywords were found or what their sources are.
+    If validators is not None, it should be a dictionary with the 'etag' and 'last_modified' headers from a previous download;
+    these are sent as a conditional request,
+    and if the server reports that the page has not been modified then the returned page's html is None.
+
+    Error responses (anything other than a 2xx or "304 Not Modified" status) raise requests.HTTPError,
+    so that an error page served during a refresh never replaces the stored article.
+
+    >>> import ragnews, types
+    >>> db = ArticleDB()
+    >>> row = dict.fromkeys(['hostname', 'publish_date', 'crawl_date', 'lang', 'en_translation', 'en_summary', 'etag', 'last_modified'])
+    >>> row.update(title='Harris accepts the nomination', text='Harris accepts the democratic nomination in Chicago.', url='https://a.com/1', body_hash='abc')
+    >>> db.add_articles([row])
+    1
+    >>> response = types.SimpleNamespace(status_code=503, text='Service Unavailable', headers={})
+    >>> session = types.SimpleNamespace(get=lambda url, headers, timeout: response)
+    >>> get_session, ragnews._get_session = ragnews._get_session, lambda: session
+    >>> _download('https://a.com/1')
+    Traceback (most recent call last):
+        ...
+    requests.exceptions.HTTPError: 503 error for url https://a.com/1
+    >>> db.add_url('https://a.com/1', refresh=True)
+    >>> ragnews._get_session = get_session
+    >>> len(db), [article['url'] for article in db.find_articles('Harris nomination')]
+    (1, ['https://a.com/1'])
     '''
-  
-    return run_llm(system, text, seed=seed)
+    headers = {}
+    if validators:
+        if validators['etag']:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified']:
+            headers['If-Modified-Since'] = validators['last_modified']
+    import requests
+    with metrics.timer('ragnews_http_request_seconds'):
+        try:
+            response = _get_session().get(url, headers=headers, timeout=30)
+        except requests.exceptions.MissingSchema:
+            url = 'https://' + url
+            response = _get_session().get(url, headers=headers, timeout=30)
+    metrics.inc('ragnews_http_responses_total', status=response.status_code)
+    not_modified = response.status_code == 304
+    if not (200 <= response.status_code < 300 or not_modified):
+        raise requests.HTTPError(f'{response.status_code} error for url {url}', response=response)
+    return {
+        'url': url,
+        'html': None if not_modified else response.text,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'body_hash': None if not_modified else _content_hash(response.text),
+        }
+
+
+def _extract_info(html, url):
+    '''
+    Extract the metainformation about the article stored in html.
+    '''
+    import metahtml
+    with metrics.timer('ragnews_extract_seconds'):
+        parsed = metahtml.parse(html, url)
+        info = metahtml.simplify_meta(parsed)
+    return info
 
-    # FIXME:
-    # Implement this function.
-    # It's okay if you don't get the exact same keywords as me.
-    # You probably certainly won't because you probably won't come up with the exact same prompt as me.
-    # To make the test cases above pass,
-    # you'll have to modify them to be what the output of your prompt provides.
+
+def _process_info(info, url):
+    '''
+    Run the LLM stages (translation and summarization) on the extracted info,
+    and return a dictionary containing one row of the articles table.
+    '''
+    if info['type'] != 'article' or len(info['content']['text']) < 100:
+        logging.debug(f'not an article... skipping')
+        en_translation = None
+        en_summary = None
+        info['title'] = None
+        info['content'] = {'text': None}
+        info['timestamp.published'] = {'lo': None}
+        info['language'] = None
+    else:
+        if not info['language'].startswith('en'):
+            en_translation = translate_text(info['content']['text'])
+        else:
+            en_translation = None
+        en_summary = summarize_text(en_translation or info['content']['text'])
+
+    return {
+        'title': info['title'],
+        'text': info['content']['text'],
+        'hostname': urlparse(url).netloc,
+        'url': url,
+        'publish_date': info['timestamp.published']['lo'],
+        'crawl_date': datetime.datetime.now().isoformat(),
+        'lang': info['language'],
+        'en_translation': en_translation,
+        'en_summary': en_summary,
+        }
+
+
+def _same_site_links(info, url):
+    '''
+    Yield the links in info that point to the same site as url.
+    Relative links are resolved against url.
+    '''
+    hostname = urlparse(url).netloc
+    for link in info['links.all']:
+        url2 = urljoin(url, link['href'])
+        parsed_uri2 = urlparse(url2)
+        hostname2 = parsed_uri2.netloc
+        if hostname in hostname2 or hostname2 in hostname:
+            yield url2
 
 
 ################################################################################
-# helper functions
+# retrieval
 ################################################################################
 
-def _logsql(sql):
-    rex = re.compile(r'\s+')
-    sql_dewhite = rex.sub(' ', sql).strip()
-    logging.debug(f'SQL: {sql_dewhite}')
+_STOPWORDS = set('''
+a about above after again against all also am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her here
+hers herself him himself his how i if in into is it its itself just me more most my myself no nor not now of off
+on once only or other our ours ourselves out over own same she should so some such than that the their theirs
+them themselves then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your yours yourself yourselves
+'''.split())
 
 
-def _catch_errors(func):
+def _tokenize(text):
     '''
-    This function is intended to be used as a decorator.
-    It traps whatever errors the input function raises and logs the errors.
-    We use this decorator on the add_urls method below to ensure that a webcrawl continues even if there are errors.
+    Split text into lowercase words, removing stopwords.
+
+    >>> _tokenize('Who is the current Democratic nominee?')
+    ['current', 'democratic', 'nominee']
     '''
-    def inner_function(*args, **kwargs):
-        try:
-            func(*args, **kwargs)
-        except Exception as e:
-            logging.error(str(e))
-    return inner_function
+    return [word for word in re.findall(r'\w+', text.lower()) if word not in _STOPWORDS]
+
+
+def _fts_query(keywords):
+    '''
+    Convert free text (e.g. the output of extract_keywords) into an FTS5 query that matches articles containing any of the words.
+    Every word is quoted, so punctuation and FTS5 operators in the input cannot cause syntax errors.
+    Returns None if the text contains no searchable words.
+
+    >>> _fts_query('Harris nominee, "democratic" NOT')
+    '"harris" OR "nominee" OR "democratic"'
+    '''
+    terms = list(dict.fromkeys(_tokenize(keywords)))
+    if not terms:
+        return None
+    return ' OR '.join(f'"{term}"' for term in terms)
+
+
+# words that are common in questions but say nothing about which articles are relevant
+_QUERY_STOPWORDS = _STOPWORDS | set('''
+according current currently describe did does explain happen happened happening know latest many much news please
+recent recently related say said tell think
+'''.split())
+
+
+def _proper_nouns(text):
+    '''
+    Return the set of lowercased words in text that look like names (of people, places, organizations, etc.).
+
+    A word is a name if it is capitalized and not at the start of a sentence,
+    or if it is an acronym (e.g. NATO),
+    or if it starts a sentence and is followed by another capitalized word (e.g. "Kamala Harris said ...").
+
+    >>> sorted(_proper_nouns('Who is the Democratic nominee? Kamala Harris said NATO would respond.'))
+    ['democratic', 'harris', 'kamala', 'nato']
+    '''
+    names = set()
+    for sentence in re.split(r'[.!?:;\n]+', text):
+        words = re.findall(r'\w+', sentence)
+        for i, word in enumerate(words):
+            if word.lower() in _STOPWORDS or not word[0].isupper():
+                continue
+            acronym = len(word) > 1 and word.isupper()
+            next_capitalized = i + 1 < len(words) and words[i + 1][0].isupper()
+            if i > 0 or acronym or next_capitalized:
+                names.add(word.lower())
+    return names
+
+
+def extract_query_terms(text, db=None, max_terms=10):
+    '''
+    Return the search terms for text as a space separated string, without calling the LLM.
+    This is the default way that rag() builds its search query (see the keyword_mode parameter of rag).
+
+    Stopwords and common question words are removed,
+    and the remaining words are ranked by how useful they are for finding relevant articles:
+    names (see _proper_nouns) count double,
+    and if db is an ArticleDB then each word is weighted by its inverse document frequency in db (see ArticleDB.term_idf),
+    so that rare words are preferred over words that appear in most articles.
+    Words that don't appear in any article of db are dropped (unless no word appears in db).
+    At most max_terms terms are returned, best first.
+
+    >>> extract_query_terms('Who is the current democratic presidential nominee?')
+    'democratic presidential nominee'
+    >>> extract_query_terms('What is the policy position of Trump related to illegal Mexican immigrants?')
+    'Trump Mexican policy position illegal immigrants'
+    '''
+    names = _proper_nouns(text)
+    terms = {}
+    for word in re.findall(r'\w+', text):
+        term = word.lower()
+        if term in _QUERY_STOPWORDS or term in terms or (len(term) == 1 and not term.isdigit()):
+            continue
+        terms[term] = word if term in names else term
+
+    weights = {term: 2.0 if term in names else 1.0 for term in terms}
+    if db is not None and terms:
+        idf = db.term_idf(list(terms))
+        if any(term in idf for term in terms):
+            weights = {term: weight * idf[term] for term, weight in weights.items() if term in idf}
+    best = sorted(weights, key=lambda term: -weights[term])[:max_terms]
+    return ' '.join(terms[term] for term in best)
+
+
+KEYWORD_MODES = ['local', 'llm', 'expand']
+
+
+def query_keywords(text, db=None, mode='local'):
+    '''
+    Return the keywords used to search db for articles relevant to text.
+
+    The mode parameter selects how the keywords are computed:
+    'local' uses extract_query_terms, which requires no network requests;
+    'llm' uses extract_keywords, which asks the LLM;
+    'expand' combines both, so that the LLM can add related words that are not in text.
+    '''
+    if mode == 'local':
+        return extract_query_terms(text, db)
+    if mode == 'llm':
+        return extract_keywords(text)
+    if mode == 'expand':
+        return extract_query_terms(text, db) + ' ' + extract_keywords(text)
+    raise ValueError(f'unknown keyword mode {mode!r}; expected one of {KEYWORD_MODES}')
+
+
+def _fts_term(term):
+    '''
+    Return term as it is stored in the FTS5 index,
+    which (with the default unicode61 tokenizer) is lowercase and without diacritics.
+
+    >>> _fts_term('Economía')
+    'economia'
+    '''
+    decomposed = unicodedata.normalize('NFKD', term.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+EMBEDDING_DIM = 256
+
+# hashed embeddings of unrelated texts still collide in a few dimensions,
+# which gives every query a handful of spurious matches with similarities of up to about 0.25;
+# dense search results below this similarity are noise and are not fused into the ranking
+# (the threshold is only applied to hashed embeddings, see dense_min_similarity)
+DENSE_MIN_SIMILARITY = 0.25
+
+_embedding_models = {}
+_embedding_models_lock = threading.Lock()
+
+
+def embedding_model_name():
+    '''
+    Return the name of the model that embed uses:
+    the sentence-transformers model named by the RAGNEWS_EMBEDDING_MODEL environment variable (e.g. all-MiniLM-L6-v2),
+    or 'hashed' (the default) for the built-in hashed embeddings.
+
+    >>> embedding_model_name()
+    'hashed'
+    '''
+    return os.environ.get('RAGNEWS_EMBEDDING_MODEL') or 'hashed'
+
+
+def dense_min_similarity():
+    '''
+    Return the similarity below which dense search results are discarded.
+    '''
+    return DENSE_MIN_SIMILARITY if embedding_model_name() == 'hashed' else 0
+
+
+def _get_embedding_model():
+    name = embedding_model_name()
+    if name == 'hashed':
+        return None
+    with _embedding_models_lock:
+        if name not in _embedding_models:
+            from sentence_transformers import SentenceTransformer
+            logging.info(f'loading embedding model {name}')
+            _embedding_models[name] = SentenceTransformer(name, device='cpu')
+        return _embedding_models[name]
+
+
+def embed(text):
+    '''
+    Return a unit length vector representation of text, suitable for cosine similarity search.
+
+    If RAGNEWS_EMBEDDING_MODEL names a sentence-transformers model,
+    the model is run locally on the CPU and the vectors capture the meaning of the text,
+    so that articles are found even when they share no words with the query.
+    This requires `pip install sentence-transformers` and downloads the model on first use.
+
+    Otherwise the vector is computed with the "hashing trick" (see _hashed_embedding).
+    Hashed embeddings are a lexical signal, not a semantic one:
+    they only give partial credit to articles that share many of the query's words and word pairs,
+    which helps rank long queries but does not find synonyms or paraphrases.
+
+    >>> vector = embed('Harris accepts the democratic nomination')
+    >>> vector.shape
+    (256,)
+    >>> round(float(vector @ vector), 4)
+    1.0
+    '''
+    return embed_many([text])[0]
+
+
+def embed_many(texts):
+    '''
+    Return a list of the embeddings of texts (see embed).
+    Embedding models encode the texts in batches, which is much faster than calling embed for each text.
+
+    >>> [vector.shape for vector in embed_many(['Harris', 'Trump'])]
+    [(256,), (256,)]
+    '''
+    model = _get_embedding_model()
+    if model is None:
+        return [_hashed_embedding(text) for text in texts]
+    import numpy as np
+    vectors = model.encode([text or '' for text in texts], batch_size=64, normalize_embeddings=True)
+    return list(np.asarray(vectors, dtype=np.float32))
+
+
+def _hashed_embedding(text, dim=EMBEDDING_DIM):
+    '''
+    Every word and every pair of adjacent words of text is hashed to one of dim dimensions (with a hashed sign),
+    and the counts are log-scaled.
+    This requires no model files and runs in microseconds on a CPU.
+
+    >>> round(float(_hashed_embedding('Harris accepts') @ _hashed_embedding('Harris declines')), 2)
+    0.33
+    >>> float(_hashed_embedding('') @ _hashed_embedding('')) == 0
+    True
+    '''
+    import numpy as np
+    vector = np.zeros(dim, dtype=np.float32)
+    words = _tokenize(text or '')
+    for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vector[h % dim] += 1 if h & 0x80000000 else -1
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def _embedding_text(row):
+    '''
+    Return the text of an article (a row of the articles table) that is used to compute its embedding.
+    The English summary/translation are preferred so that non-English articles can be found with English queries.
+    '''
+    body = row['en_summary'] or row['en_translation'] or row['text'] or ''
+    return f"{row['title'] or ''} {body}"
+
+
+def _reciprocal_rank_fusion(rankings, k=60):
+    '''
+    Combine several rankings (lists of ids, best first) into a single list of (id, score) pairs sorted by score.
+    Each id receives a score of 1/(k + rank) from every ranking it appears in.
+
+    >>> _reciprocal_rank_fusion([[1, 2, 3], [3, 1]])
+    [(1, 0.03252247488101534), (3, 0.032266458495966696), (2, 0.016129032258064516)]
+    '''
+    scores = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking):
+            scores[id_] = scores.get(id_, 0) + 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _split_passages(text, max_words=100):
+    '''
+    Split text into passages of consecutive sentences containing at most max_words words
+    (a single sentence longer than max_words becomes its own passage).
+
+    >>> _split_passages('One two. Three four! Five six?', max_words=4)
+    ['One two. Three four!', 'Five six?']
+    '''
+    passages = []
+    passage = []
+    num_words = 0
+    for sentence in re.split(r'(?<=[.!?])\s+', text.strip()):
+        sentence_words = len(sentence.split())
+        if passage and num_words + sentence_words > max_words:
+            passages.append(' '.join(passage))
+            passage = []
+            num_words = 0
+        passage.append(sentence)
+        num_words += sentence_words
+    if passage and passage != ['']:
+        passages.append(' '.join(passage))
+    return passages
+
+
+def _shingles(words, n=3):
+    return set(zip(*[words[i:] for i in range(n)])) or {tuple(words)}
+
+
+def pack_context(query, articles, token_budget=1500, max_words=100):
+    '''
+    Return a string containing the passages from articles that are most relevant to query,
+    using at most (approximately) token_budget tokens.
+
+    Each article's English text (its summary, plus its translation or English text) is split into passages.
+    Passages are ranked by BM25 computed over the passages of all of the articles,
+    passages that are near-duplicates (Jaccard similarity of their word trigrams above 0.5) of a higher ranked passage are removed,
+    and the best passages are added until the token budget is used up.
+    Passages that do not contain any of the query's words are never included;
+    if no passage matches, only the titles and urls of the articles are listed.
+    The passages are grouped under the title and url of their article, with articles in the order they were given.
+    This keeps the prompt size (and so the generation latency and cost) bounded
+    no matter how many articles were retrieved.
+
+    >>> articles = [
+    ...     {'title': 'A', 'url': 'a', 'en_summary': 'Harris accepted the nomination. The weather was nice.'},
+    ...     {'title': 'B', 'url': 'b', 'en_summary': 'Harris accepted the nomination.'},
+    ...     ]
+    >>> print(pack_context('harris nomination', articles, max_words=5))
+    A - a
+    Harris accepted the nomination.
+    '''
+    query_terms = set(_tokenize(query))
+    candidates = []
+    for i, article in enumerate(articles):
+        texts = [article.get('en_summary')]
+        if article.get('en_translation'):
+            texts.append(article['en_translation'])
+        elif (article.get('lang') or 'en').startswith('en'):
+            texts.append(article.get('text'))
+        for text in texts:
+            for passage in _split_passages(text or '', max_words=max_words):
+                terms = _tokenize(passage)
+                if terms:
+                    candidates.append((i, passage, terms))
+    # BM25 over the passages
+    k1, b = 1.2, 0.75
+    avg_length = sum(len(terms) for _, _, terms in candidates) / max(1, len(candidates))
+    doc_freq = {term: 0 for term in query_terms}
+    for _, _, terms in candidates:
+        for term in query_terms.intersection(terms):
+            doc_freq[term] += 1
+    def score(terms):
+        total = 0
+        for term in query_terms:
+            tf = terms.count(term)
+            if tf:
+                idf = math.log(1 + (len(candidates) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                total += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(terms) / avg_length))
+        return total
+    scored = [(score(terms), i, passage, terms) for i, passage, terms in candidates]
+    ranked = sorted((candidate for candidate in scored if candidate[0] > 0), key=lambda candidate: candidate[0], reverse=True)
+
+    selected = {}
+    selected_shingles = []
+    tokens = 0
+    for _, i, passage, terms in ranked:
+        shingles = _shingles(terms)
+        if any(len(shingles & other) / len(shingles | other) > 0.5 for other in selected_shingles):
+            continue
+        passage_tokens = _estimate_tokens(passage)
+        if i not in selected:
+            header = f"{articles[i]['title']} - {articles[i]['url']}"
+            passage_tokens += _estimate_tokens(header)
+        if tokens + passage_tokens > token_budget:
+            continue
+        tokens += passage_tokens
+        selected.setdefault(i, []).append(passage)
+        selected_shingles.append(shingles)
+
+    # if no passage mentions the query, fall back to listing the articles
+    if not selected:
+        for i in range(len(articles)):
+            header = f"{articles[i]['title']} - {articles[i]['url']}"
+            tokens += _estimate_tokens(header)
+            if tokens > token_budget:
+                break
+            selected[i] = []
+
+    lines = []
+    for i in sorted(selected):
+        lines.append(f"{articles[i]['title']} - {articles[i]['url']}")
+        lines.extend(selected[i])
+    return '\n'.join(lines)
+
+
+class RAGCache:
+    '''
+    A memory-bounded LRU cache of rag() responses.
+
+    Entries are keyed on the normalized question (lowercase, without punctuation or extra whitespace)
+    together with everything else that affects the response (the keywords text, the context size, the LLM backend, and the db).
+    Each entry is tagged with the corpus version of the db (see ArticleDB.corpus_version) when it was computed,
+    so once new articles are added to the db the old responses are no longer returned.
+
+    If similarity is not None, then a question that misses the exact lookup
+    can also be answered by a cached question whose embedding has cosine similarity of at least similarity with it.
+    This lets paraphrases ("who is the democratic nominee" and "who's the democratic nominee?") share an entry.
+
+    >>> cache = RAGCache(max_entries=2)
+    >>> cache.put('Who is the nominee?', 'context', 1, 'Harris')
+    >>> cache.get('who is the   NOMINEE', 'context', 1)
+    'Harris'
+    >>> cache.get('who is the nominee', 'context', 2) is None
+    True
+    >>> cache.stats()
+    {'hits': 1, 'paraphrase_hits': 0, 'misses': 1, 'hit_rate': 0.5, 'entries': 0}
+    '''
+
+    def __init__(self, max_entries=1000, similarity=None):
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.enabled = True
+        self.hits = 0
+        self.paraphrase_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(re.findall(r'\w+', text.lower()))
+
+    def get(self, text, context, version, paraphrase=True):
+        '''
+        Return the cached response for text, or None.
+        The context is any hashable value containing the other parameters the response depends on,
+        and version is the current corpus version.
+        Set paraphrase=False to only allow exact matches.
+        '''
+        question = self.normalize(text)
+        with self._lock:
+            key = (question, context)
+            entry = self._entries.get(key)
+            if entry is not None and entry['version'] != version:
+                del self._entries[key]
+                entry = None
+            if entry is None and paraphrase and self.similarity is not None:
+                entry = self._find_paraphrase(question, context, version)
+                if entry is not None:
+                    self.paraphrase_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry['key'])
+            self.hits += 1
+            return entry['response']
+
+    def _find_paraphrase(self, question, context, version):
+        vector = embed(question)
+        best = None
+        best_similarity = self.similarity
+        for entry in self._entries.values():
+            if entry['key'][1] == context and entry['version'] == version and entry['vector'] is not None:
+                similarity = float(entry['vector'] @ vector)
+                if similarity >= best_similarity:
+                    best = entry
+                    best_similarity = similarity
+        return best
+
+    def put(self, text, context, version, response):
+        '''
+        Store the response, evicting the least recently used entry if the cache is full.
+        '''
+        question = self.normalize(text)
+        key = (question, context)
+        with self._lock:
+            self._entries[key] = {
+                'key': key,
+                'version': version,
+                'response': response,
+                'vector': embed(question) if self.similarity is not None else None,
+                }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        '''
+        Return a dictionary with the hit/miss counters of the cache.
+        '''
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'paraphrase_hits': self.paraphrase_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _make_rag_cache():
+    '''
+    Create the rag cache from the RAGNEWS_RAG_CACHE* environment variables.
+    RAGNEWS_RAG_CACHE_SIZE is the maximum number of entries (0 disables the cache),
+    and RAGNEWS_RAG_CACHE_SIMILARITY enables paraphrase matching with the given similarity threshold.
+    '''
+    max_entries = int(os.environ.get('RAGNEWS_RAG_CACHE_SIZE', 1000))
+    similarity = os.environ.get('RAGNEWS_RAG_CACHE_SIMILARITY')
+    cache = RAGCache(max_entries=max_entries, similarity=float(similarity) if similarity else None)
+    cache.enabled = max_entries > 0
+    return cache
+
+
+rag_cache = _make_rag_cache()
 
 
 ################################################################################
@@ -128,21 +734,68 @@ def _catch_errors(func):
 ################################################################################
 
 
-def rag(text, db, keywords_text=None):
+def rag(text, db, keywords_text=None, timings=None, stream=False, context_tokens=1500, use_cache=True, keyword_mode=None):
     '''
     This function uses retrieval augmented generation (RAG) to generate an LLM response to the input text.
     The db argument should be an instance of the `ArticleDB` class that contains the relevant documents to use.
+
+    The articles are found using keywords computed from keywords_text (which defaults to text);
+    see query_keywords for the possible values of keyword_mode.
+    The default mode ('local', or the RAGNEWS_KEYWORD_MODE environment variable) does not call the LLM,
+    so only the final answer requires a network request.
+
+    The most relevant passages of the retrieved articles are included in the prompt,
+    limited to approximately context_tokens tokens (see pack_context).
+
+    If stream is True, then the return value is a generator that yields pieces of the response as the LLM generates them
+    instead of the complete response.
+
+    If timings is a dictionary, the number of seconds spent in each stage of the pipeline
+    is stored in its 'keywords', 'retrieval', and 'generation' keys.
+    When streaming, the 'ttft' key stores the time from calling rag until the first piece of the response was generated,
+    and the 'generation' key is only set once the generator is exhausted.
+
+    Responses are stored in rag_cache (see RAGCache) and reused until new articles are added to db;
+    set use_cache=False to bypass it.
+    When the response comes from the cache, the only key stored in timings is 'cache'.
+    Paraphrase matching is only used for plain questions (when keywords_text is None),
+    because prompts that differ only in their keywords_text would otherwise look like paraphrases.
     '''
+    rag_start = time.perf_counter()
+    if timings is None:
+        timings = {}
+    if keyword_mode is None:
+        keyword_mode = os.environ.get('RAGNEWS_KEYWORD_MODE', 'local')
+
+    use_cache = use_cache and rag_cache.enabled
+    if use_cache:
+        context = (keywords_text, context_tokens, keyword_mode, get_backend().name, db.cache_id)
+        version = db.corpus_version()
+        cache_text = text if keywords_text is None else f'{text}\n{keywords_text}'
+        response = rag_cache.get(cache_text, context, version, paraphrase=keywords_text is None)
+        if response is not None:
+            timings['cache'] = time.perf_counter() - rag_start
+            return iter([response]) if stream else response
+        def store(response):
+            rag_cache.put(cache_text, context, version, response)
+    else:
+        def store(response):
+            pass
+
     if keywords_text is None:
           keywords_text = text
     #1. extract keywords from the text
 
-    keywords = extract_keywords(keywords_text)
+    start = time.perf_counter()
+    keywords = query_keywords(keywords_text, db, keyword_mode)
+    timings['keywords'] = time.perf_counter() - start
 
     #2. use key words to find articles related to the text
+    start = time.perf_counter()
     articles = db.find_articles(keywords)
+    timings['retrieval'] = time.perf_counter() - start
 
-    articles_str = "\n".join([f"{article['title']} - {article['url']}" for article in articles])    
+    articles_str = pack_context(f'{keywords_text} {keywords}', articles, token_budget=context_tokens)
     # 3. Construct a new user prompt that includes all of the articles and the original text.
     user = f'''
     Here is the original text:
@@ -164,7 +817,12 @@ def rag(text, db, keywords_text=None):
     #logging.info('rag.USER: ' + user)
 
     # Step 5: Pass the new prompts to the LLM and return the result
+    if stream:
+        return _timed_stream(run_llm_stream(system, user), timings, rag_start, on_complete=store)
+    start = time.perf_counter()
     response = run_llm(system, user)
+    timings['generation'] = time.perf_counter() - start
+    store(response)
     #response = " ".join(response.split("Keywords:**\n\n* ")[-1].split("\n* "))
     return response
 
@@ -184,6 +842,376 @@ def rag(text, db, keywords_text=None):
     # Then, you can iteratively add more commands into the system prompt to correct "bad" behavior you see in your program's output.
 
 
+def _timed_stream(chunks, timings, start, on_complete=None):
+    '''
+    Yield the chunks, recording the time to the first chunk and the total generation time in timings.
+    The time to the first chunk is also recorded in the ragnews_rag_ttft_seconds metric.
+    Once all chunks have been yielded, on_complete (if given) is called with the complete response.
+    '''
+    generation_start = time.perf_counter()
+    response = []
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            timings['ttft'] = time.perf_counter() - start
+            metrics.observe('ragnews_rag_ttft_seconds', timings['ttft'])
+        response.append(chunk)
+        yield chunk
+    timings['generation'] = time.perf_counter() - generation_start
+    if on_complete is not None:
+        on_complete(''.join(response))
+
+
+def _idf(doc_freqs, num_articles):
+    '''
+    Convert a dictionary of document frequencies into a dictionary of BM25 inverse document frequencies.
+
+    >>> idf = _idf({'election': 90, 'walz': 2}, 100)
+    >>> round(idf['election'], 2), round(idf['walz'], 2)
+    (0.11, 3.7)
+    '''
+    num_articles = max(num_articles, max(doc_freqs.values(), default=0))
+    return {
+        term: math.log((num_articles - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+        for term, doc_freq in doc_freqs.items()
+        }
+
+
+class _BatchWriter:
+    '''
+    Buffers rows for the ArticleDB.batch method.
+    '''
+
+    def __init__(self, articledb, batch_size):
+        self.articledb = articledb
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        logging.debug(f'inserting {len(self.rows)} rows into database')
+
+        # a url that appears more than once in the batch keeps only its last row;
+        # re-inserting a url that is already in the db replaces its article
+        params = {}
+        for row in self.rows:
+            url_key = _normalize_url(row['url'])
+            params[url_key] = dict(
+                row,
+                url_key=url_key,
+                content_hash=_content_hash(row['text']),
+                etag=row.get('etag'),
+                last_modified=row.get('last_modified'),
+                body_hash=row.get('body_hash'),
+                )
+        params = list(params.values())
+
+        sqls = [
+            # the article count goes up for every new article and down for every article replaced by a non-article
+            '''
+            UPDATE meta
+            SET value = value + (:content_hash IS NOT NULL) - (
+                SELECT count(*) FROM urls WHERE url=:url_key AND content_hash IS NOT NULL
+                )
+            WHERE key='article_count';
+            ''',
+            '''
+            INSERT INTO urls(url, content_hash, crawl_date, etag, last_modified, body_hash)
+            VALUES (:url_key, :content_hash, :crawl_date, :etag, :last_modified, :body_hash)
+            ON CONFLICT(url) DO UPDATE SET
+                content_hash=excluded.content_hash,
+                crawl_date=excluded.crawl_date,
+                etag=excluded.etag,
+                last_modified=excluded.last_modified,
+                body_hash=excluded.body_hash;
+            ''',
+            '''
+            DELETE FROM articles WHERE rowid = (SELECT id FROM urls WHERE url=:url_key);
+            ''',
+            '''
+            INSERT INTO articles(rowid, title, text, hostname, url, publish_date, crawl_date, lang, en_translation, en_summary)
+            SELECT id, :title, :text, :hostname, :url, :publish_date, :crawl_date, :lang, :en_translation, :en_summary
+            FROM urls WHERE url=:url_key;
+            ''',
+            ]
+        # embeddings are computed once here, at ingest time;
+        # rows without text (i.e. non-articles) have no embedding,
+        # and replacing an article by one without text leaves an empty vector behind
+        # so that _VectorIndex.refresh removes the old embedding from memory
+        texts = [_embedding_text(param) for param in params if param['text'] is not None]
+        vectors = iter(embed_many(texts) if texts else [])
+        for param in params:
+            param['vector'] = None if param['text'] is None else next(vectors).tobytes()
+        sqls += [
+            '''
+            UPDATE vectors
+            SET seq=(SELECT coalesce(max(seq), 0) + 1 FROM vectors), vector=x''
+            WHERE id = (SELECT id FROM urls WHERE url=:url_key) AND :vector IS NULL;
+            ''',
+            '''
+            INSERT OR REPLACE INTO vectors(id, seq, vector)
+            SELECT id, (SELECT coalesce(max(seq), 0) + 1 FROM vectors), :vector
+            FROM urls WHERE url=:url_key AND :vector IS NOT NULL;
+            ''',
+            ]
+
+        with metrics.timer('ragnews_insert_seconds'), self.articledb.db:
+            for sql in sqls:
+                _logsql(sql)
+                self.articledb.db.executemany(sql, params)
+            sql = '''
+            UPDATE meta SET value = value + 1 WHERE key='corpus_version';
+            '''
+            _logsql(sql)
+            self.articledb.db.execute(sql)
+        metrics.inc('ragnews_rows_inserted_total', len(self.rows))
+        self.count += len(self.rows)
+        self.rows = []
+
+
+class _VectorIndex:
+    '''
+    An in-memory index of the embeddings stored in an ArticleDB's vectors table.
+
+    Small indexes are searched exhaustively.
+    Once an index holds PARTITION_MIN_VECTORS vectors, they are clustered with k-means into about sqrt(n) partitions,
+    and a query only scores the vectors of the nprobe partitions whose centroids are most similar to it,
+    so that the cost of a query grows with sqrt(n) instead of n (at the price of occasionally missing a match).
+    New vectors are added to the partition of their nearest centroid,
+    and the partitions are rebuilt whenever the index has doubled in size since they were last built.
+    Embeddings that do not cluster (e.g. the hashed embeddings of texts that share most of their words)
+    would need so many partitions probed that partitioning would not pay off, so such indexes stay exhaustive
+    (see _partition).
+
+    The index lives in memory only and is loaded from the vectors table by the first search;
+    ArticleDBs that share one _VectorIndex (see ArticleDBPool) load it once.
+    '''
+
+    PARTITION_MIN_VECTORS = 20000
+    NPROBE = 16
+    MIN_RECALL = 0.9
+    MAX_SCANNED = 0.25
+
+    def __init__(self):
+        self._clear()
+        self.lock = threading.Lock()
+
+    def _clear(self):
+        self.size = 0
+        self.ids = None
+        self.vectors = None
+        self.positions = {}
+        self.seq = 0
+        self.centroids = None
+        self.partition_of = None
+        self.members = None
+        self.moved = False
+        self.partitioned_size = 0
+
+    def refresh(self, db):
+        '''
+        Bring the index up to date with the vectors table of the sqlite connection db.
+
+        Every write to the vectors table is tagged with an increasing seq number,
+        so only the vectors written since the last call need to be read from disk.
+        An empty vector means that the article's embedding was deleted;
+        its row of the matrix is zeroed so that it is never returned by search.
+        If the vectors change dimension (because the articles were re-embedded with another model),
+        the whole index is reloaded.
+
+        >>> db = ArticleDB()
+        >>> row = dict.fromkeys(['hostname', 'publish_date', 'crawl_date', 'lang', 'en_translation', 'en_summary'])
+        >>> row.update(title='Harris accepts the nomination', text='Harris accepts the democratic nomination in Chicago.', url='https://a.com/1')
+        >>> db.add_articles([row])
+        1
+        >>> [rowid for rowid, similarity in db._dense_search('Harris nomination', 10)]
+        [1]
+        >>> db.add_articles([dict(row, title=None, text=None)])
+        1
+        >>> db._dense_search('Harris nomination', 10)
+        []
+        '''
+        sql = '''
+        SELECT id, seq, vector
+        FROM vectors
+        WHERE seq > ?
+        ORDER BY seq;
+        '''
+        with self.lock:
+            _logsql(sql)
+            if not self._load(db.execute(sql, [self.seq]), db):
+                self._clear()
+                self._load(db.execute(sql, [self.seq]), db)
+
+    def _load(self, rows, db):
+        '''
+        Add the (id, seq, vector) rows to the index.
+        Return False (leaving the index in an inconsistent state) if a vector has a different dimension than the index.
+        '''
+        import numpy as np
+        changed = []
+        for id_, seq, blob in rows:
+            self.seq = seq
+            if blob:
+                vector = np.frombuffer(blob, dtype=np.float32)
+                if self.vectors is None:
+                    capacity = max(1024, db.execute('SELECT count(*) FROM vectors;').fetchone()[0])
+                    self.ids = np.zeros(capacity, dtype=np.int64)
+                    self.vectors = np.zeros((capacity, len(vector)), dtype=np.float32)
+                elif len(vector) != self.vectors.shape[1]:
+                    return False
+            elif self.vectors is None:
+                continue
+            else:
+                vector = 0
+            if id_ in self.positions:
+                position = self.positions[id_]
+            else:
+                position = self.size
+                if position == len(self.ids):
+                    self.ids = np.concatenate([self.ids, np.zeros(len(self.ids) // 4, dtype=np.int64)])
+                    self.vectors = np.concatenate([self.vectors, np.zeros((len(self.ids) - len(self.vectors), self.vectors.shape[1]), dtype=np.float32)])
+                self.positions[id_] = position
+                self.ids[position] = id_
+                self.size += 1
+            self.vectors[position] = vector
+            changed.append(position)
+        if self.size >= self.PARTITION_MIN_VECTORS and self.size >= 2 * self.partitioned_size:
+            self._partition()
+        elif self.centroids is not None and changed:
+            self._assign(np.unique(np.array(changed, dtype=np.int64)))
+        return True
+
+    def _partition(self, iterations=5):
+        '''
+        Cluster the vectors into about sqrt(n) partitions with spherical k-means,
+        trained on a random sample of the vectors.
+
+        The number of partitions that a query probes is chosen by using some of the sample vectors as queries:
+        it is doubled (starting from NPROBE) until the partitions probed for those queries
+        contain at least MIN_RECALL of their 10 nearest neighbours in the sample.
+        If that would mean scoring more than MAX_SCANNED of the vectors,
+        the vectors do not cluster well enough for partitioning to pay off, and the index stays exhaustive.
+        '''
+        import numpy as np
+        rng = np.random.default_rng(0)
+        k = int(math.sqrt(self.size))
+        sample = self.vectors[rng.choice(self.size, min(self.size, 32 * k), replace=False)]
+        centroids = sample[rng.choice(len(sample), k, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            nonempty = norms > 0
+            centroids[nonempty] = sums[nonempty] / norms[nonempty, None]
+        self.partitioned_size = self.size
+        partition_of = np.concatenate([
+            np.argmax(self.vectors[i:min(i + 16384, self.size)] @ centroids.T, axis=1)
+            for i in range(0, self.size, 16384)
+            ])
+        fractions = np.bincount(partition_of, minlength=k) / self.size
+
+        queries = sample[:200]
+        neighbour_partitions = np.argmax(sample @ centroids.T, axis=1)[np.argsort(-(queries @ sample.T), axis=1)[:, 1:11]]
+        ranked_partitions = np.argsort(-(queries @ centroids.T), axis=1)
+        nprobe = min(self.NPROBE, k)
+        while True:
+            probes = ranked_partitions[:, :nprobe]
+            recall = float((neighbour_partitions[:, :, None] == probes[:, None, :]).any(axis=2).mean())
+            scanned = float(fractions[probes].sum(axis=1).mean())
+            if recall >= self.MIN_RECALL or scanned > self.MAX_SCANNED:
+                break
+            nprobe *= 2
+        if scanned > self.MAX_SCANNED:
+            logging.info(f'not partitioning the vector index: a query would have to score {scanned:.0%} of the vectors')
+            self.centroids = self.partition_of = self.members = None
+            return
+        logging.info(f'partitioned the vector index into {k} partitions; queries probe {nprobe} of them')
+        self.centroids = centroids
+        self.nprobe = nprobe
+        self.partition_of = np.full(len(self.ids), -1, dtype=np.int64)
+        self.partition_of[:self.size] = partition_of
+        order = np.argsort(partition_of, kind='stable')
+        self.members = [[group] for group in np.split(order, np.cumsum(np.bincount(partition_of, minlength=k))[:-1])]
+        self.moved = False
+
+    def _assign(self, positions, chunk_size=16384):
+        '''
+        Add the (new or updated) vectors at positions to the partitions of their nearest centroids.
+        Updated vectors that move to another partition stay listed in their old partition;
+        once that has happened, search has to skip them there by checking partition_of.
+        '''
+        import numpy as np
+        assigned = len(self.partition_of)
+        if assigned < len(self.ids):
+            self.partition_of = np.concatenate([self.partition_of, np.full(len(self.ids) - assigned, -1, dtype=np.int64)])
+        for i in range(0, len(positions), chunk_size):
+            chunk = positions[i:i + chunk_size]
+            partitions = np.argmax(self.vectors[chunk] @ self.centroids.T, axis=1)
+            unchanged = self.partition_of[chunk] == partitions
+            self.moved = self.moved or bool(np.any(self.partition_of[chunk][~unchanged] >= 0))
+            self.partition_of[chunk] = partitions
+            chunk = chunk[~unchanged]
+            partitions = partitions[~unchanged]
+            if not len(chunk):
+                continue
+            order = np.argsort(partitions, kind='stable')
+            bounds = np.flatnonzero(np.diff(partitions[order])) + 1
+            for group in np.split(chunk[order], bounds):
+                self.members[self.partition_of[group[0]]].append(group)
+
+    def search(self, vector, limit, min_similarity=0):
+        '''
+        Return (id, similarity) pairs for the (at most limit) stored vectors
+        whose cosine similarity to vector is highest and greater than min_similarity, best first.
+
+        >>> import numpy as np
+        >>> index = _VectorIndex()
+        >>> index.PARTITION_MIN_VECTORS, index.NPROBE = 1000, 4
+        >>> db = sqlite3.connect(':memory:')
+        >>> _ = db.execute('CREATE TABLE vectors (id INTEGER PRIMARY KEY, seq INTEGER, vector BLOB);')
+        >>> rng = np.random.default_rng(1)
+        >>> topics = rng.normal(size=(40, 32))
+        >>> vectors = (topics[rng.integers(0, 40, 4000)] + 0.3 * rng.normal(size=(4000, 32))).astype(np.float32)
+        >>> vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        >>> _ = db.executemany('INSERT INTO vectors VALUES (?, ?, ?);', ((i, i, v.tobytes()) for i, v in enumerate(vectors)))
+        >>> index.refresh(db)
+        >>> len(index.centroids), index.nprobe
+        (63, 4)
+        >>> [id_ for id_, similarity in index.search(vectors[1234], 3)][0]
+        1234
+        '''
+        import numpy as np
+        with self.lock:
+            if not self.size:
+                return []
+            if self.centroids is None:
+                candidates = np.arange(self.size)
+                scores = self.vectors[:self.size] @ vector
+            else:
+                probes = np.argpartition(-(self.centroids @ vector), self.nprobe - 1)[:self.nprobe]
+                groups = [group for p in probes for group in self.members[p]]
+                if not groups:
+                    return []
+                candidates = np.concatenate(groups)
+                if self.moved:
+                    candidates = np.unique(candidates[np.isin(self.partition_of[candidates], probes)])
+                scores = self.vectors[candidates] @ vector
+            if limit < len(scores):
+                top = np.argpartition(-scores, limit)[:limit]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            return [(int(self.ids[candidates[i]]), float(scores[i])) for i in top if scores[i] > max(min_similarity, 0)]
+
+
 class ArticleDB:
     '''
     This class represents a database of news articles.
@@ -217,19 +1245,92 @@ class ArticleDB:
         'https://www.cnn.com/2024/09/06/politics/american-push-israel-hamas-deal-analysis/index.html',
     ]
 
-    def __init__(self, filename=':memory:'):
-        self.db = sqlite3.connect(filename)
+    def __init__(self, filename=':memory:', readonly=False, vector_index=None, mmap_size=None, check_same_thread=True):
+        '''
+        If readonly is True, the database file is opened read-only and can be used from any thread
+        (but only by one thread at a time); see ArticleDBPool.
+        Writable databases can also be used from other threads than the one that opened them if check_same_thread is False,
+        in which case the caller is responsible for using the db from only one thread at a time.
+        File databases are put in WAL mode so that readers are never blocked by a crawl that is writing.
+        The vector_index parameter allows several ArticleDBs for the same file to share one in-memory embedding matrix.
+        If mmap_size is given, up to mmap_size bytes of the file are read through a memory map instead of sqlite's page cache
+        (see ShardedArticleDB).
+        '''
+        if filename == ':memory:':
+            self.cache_id = f':memory:{id(self)}'
+        else:
+            self.cache_id = os.path.abspath(filename)
+        if readonly:
+            uri = 'file:' + quote(os.path.abspath(filename)) + '?mode=ro'
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(filename, check_same_thread=check_same_thread)
         self.db.row_factory = sqlite3.Row
+        if mmap_size:
+            self.db.execute(f'PRAGMA mmap_size={int(mmap_size)};')
         self.logger = logging
-        self._create_schema()
+        self.vector_index = vector_index or _VectorIndex()
+        if not readonly:
+            if filename != ':memory:':
+                self.db.execute('PRAGMA journal_mode=WAL;')
+            self._create_schema()
+        self._check_embedding_model(readonly)
 
     def _create_schema(self):
         '''
-        Create the DB schema if it doesn't already exist.
+        Create the DB schema if it doesn't already exist,
+        and migrate databases that were created with an older schema.
+
+        The articles table is an FTS5 table, and FTS5 cannot use an index for equality lookups on its columns.
+        So every article also has a row in the ordinary urls table,
+        whose id is the rowid of the article in the articles table.
+        The urls table has a unique index on the normalized url,
+        which makes dedupe checks and counting articles O(log n) instead of full scans.
+        The urls table also stores the HTTP caching headers and a hash of the downloaded page,
+        which are used to skip unchanged pages when refreshing.
+        The vectors table stores the embedding of each article (keyed by the same id) for dense retrieval.
+        The meta table stores the corpus version (see the corpus_version method), the number of articles (see __len__)
+        and the embedding model that computed the vectors (see _check_embedding_model).
+        The articles_vocab table is a view of the terms in the full text index, used to compute term_idf.
+        The schema version is stored in sqlite's user_version pragma.
+
+        Several processes or threads may open the same file at once (e.g. the workers of evaluate.py),
+        so the schema version is read and the migrations are run inside a single write transaction;
+        the other connections wait for the migrating one to commit and then find the schema up to date.
+        Databases created before the urls table existed may contain the same url several times;
+        opening them keeps only one copy of each url.
+
+        >>> import tempfile, threading
+        >>> path = os.path.join(tempfile.mkdtemp(), 'baseline.db')
+        >>> baseline = sqlite3.connect(path)
+        >>> _ = baseline.execute('CREATE VIRTUAL TABLE articles USING FTS5 (title, text, hostname, url, publish_date, crawl_date, lang, en_translation, en_summary);')
+        >>> for url in ['https://a.com/1', 'https://a.com/1', 'https://a.com/2']:
+        ...     _ = baseline.execute("INSERT INTO articles(title, text, url) VALUES ('title', 'some text', ?);", [url])
+        >>> baseline.commit()
+        >>> baseline.close()
+        >>> errors = []
+        >>> def open_baseline():
+        ...     try:
+        ...         ArticleDB(path, check_same_thread=False).db.close()
+        ...     except Exception as e:
+        ...         errors.append(e)
+        >>> threads = [threading.Thread(target=open_baseline) for _ in range(4)]
+        >>> for thread in threads: thread.start()
+        >>> for thread in threads: thread.join()
+        >>> errors
+        []
+        >>> db = ArticleDB(path)
+        >>> len(db)
+        2
+        >>> db.db.execute('PRAGMA user_version;').fetchone()[0]
+        6
         '''
+        if self.db.execute('PRAGMA user_version;').fetchone()[0] >= 6:
+            return
+        self.db.execute('BEGIN IMMEDIATE;')
         try:
             sql = '''
-            CREATE VIRTUAL TABLE articles
+            CREATE VIRTUAL TABLE IF NOT EXISTS articles
             USING FTS5 (
                 title,
                 text,
@@ -242,152 +1343,758 @@ class ArticleDB:
                 en_summary
                 );
             '''
+            _logsql(sql)
             self.db.execute(sql)
+            version = self.db.execute('PRAGMA user_version;').fetchone()[0]
+            if version < 1:
+                self._migrate_urls_table()
+            if version < 2:
+                self._migrate_vectors_table()
+            if version < 3:
+                self._migrate_http_validators()
+            if version < 4:
+                self._migrate_meta_table()
+            if version < 5:
+                self._migrate_vocab_table()
+            if version < 6:
+                self._migrate_article_count()
             self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+
+    def _migrate_urls_table(self):
+        '''
+        Create the urls table and fill it from the existing contents of the articles table.
+
+        Older databases may contain the same url several times (from crawls with allow_dupes=True);
+        only the most recently inserted copy of each url is kept.
+        '''
+        self.logger.info('migrating database: creating urls table')
+        self.db.create_function('normalize_url', 1, _normalize_url)
+        self.db.create_function('content_hash', 1, _content_hash)
+        sqls = [
+            '''
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                content_hash TEXT,
+                crawl_date TEXT
+                );
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS urls_content_hash ON urls(content_hash);
+            ''',
+            '''
+            INSERT OR IGNORE INTO urls(id, url, content_hash, crawl_date)
+            SELECT rowid, normalize_url(url), content_hash(text), crawl_date
+            FROM articles
+            ORDER BY rowid DESC;
+            ''',
+            '''
+            DELETE FROM articles WHERE rowid NOT IN (SELECT id FROM urls);
+            ''',
+            '''
+            PRAGMA user_version = 1;
+            ''',
+            ]
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+
+    def _migrate_vectors_table(self):
+        '''
+        Create the vectors table and compute the (hashed) embeddings of all existing articles;
+        _check_embedding_model re-embeds them afterwards if another embedding model is configured.
+        '''
+        self.logger.info('migrating database: creating vectors table')
+        sqls = [
+            '''
+            CREATE TABLE IF NOT EXISTS vectors (
+                id INTEGER PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                vector BLOB NOT NULL
+                );
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS vectors_seq ON vectors(seq);
+            ''',
+            ]
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+        sql = '''
+        SELECT rowid, title, text, en_translation, en_summary
+        FROM articles
+        WHERE text IS NOT NULL;
+        '''
+        _logsql(sql)
+        rows = self.db.execute(sql)
+        sql = '''
+        INSERT OR REPLACE INTO vectors(id, seq, vector) VALUES (?, 1, ?);
+        '''
+        _logsql(sql)
+        self.db.executemany(sql, ((row['rowid'], _hashed_embedding(_embedding_text(row)).tobytes()) for row in rows))
+        self.db.execute('PRAGMA user_version = 2;')
+
+    def _migrate_http_validators(self):
+        '''
+        Add the columns used by refresh crawls to the urls table.
+        '''
+        self.logger.info('migrating database: adding http validators to urls table')
+        # earlier versions ran this migration outside of a transaction,
+        # so a database may already have some of the columns
+        columns = {row['name'] for row in self.db.execute('PRAGMA table_info(urls);')}
+        sqls = [
+            f'''
+            ALTER TABLE urls ADD COLUMN {column} TEXT;
+            '''
+            for column in ['etag', 'last_modified', 'body_hash']
+            if column not in columns
+            ]
+        sqls.append('''
+            PRAGMA user_version = 3;
+            ''')
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+
+    def _migrate_meta_table(self):
+        '''
+        Create the meta table, which stores the corpus version.
+        '''
+        self.logger.info('migrating database: creating meta table')
+        sqls = [
+            '''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+                );
+            ''',
+            '''
+            INSERT OR IGNORE INTO meta(key, value) VALUES ('corpus_version', 0);
+            ''',
+            '''
+            PRAGMA user_version = 4;
+            ''',
+            ]
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+
+    def _migrate_vocab_table(self):
+        '''
+        Create the articles_vocab table,
+        which contains the number of articles containing each term of the articles table.
+        '''
+        self.logger.info('migrating database: creating articles_vocab table')
+        sqls = [
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS articles_vocab
+            USING fts5vocab(articles, 'row');
+            ''',
+            '''
+            PRAGMA user_version = 5;
+            ''',
+            ]
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+
+    def _migrate_article_count(self):
+        '''
+        Store the number of articles in the meta table, so that __len__ does not have to count them.
+        '''
+        self.logger.info('migrating database: storing article count')
+        sqls = [
+            '''
+            INSERT OR REPLACE INTO meta(key, value)
+            SELECT 'article_count', count(*) FROM urls WHERE content_hash IS NOT NULL;
+            ''',
+            '''
+            PRAGMA user_version = 6;
+            ''',
+            ]
+        for sql in sqls:
+            _logsql(sql)
+            self.db.execute(sql)
+
+    def _stored_embedding_model(self):
+        sql = "SELECT value FROM meta WHERE key='embedding_model';"
+        _logsql(sql)
+        try:
+            row = self.db.execute(sql).fetchone()
         except sqlite3.OperationalError:
-            self.logger.debug('CREATE TABLE failed')
+            # read-only databases that were never opened for writing have no meta table
+            row = None
+        return row[0] if row else 'hashed'
+
+    def _check_embedding_model(self, readonly):
+        '''
+        Make sure that the embeddings in the vectors table were computed with the current embedding model
+        (see embedding_model_name), which is recorded in the meta table.
+        Writable databases re-embed all of their articles when the model has changed.
+        Read-only databases cannot, so their dense search is disabled until a writer has re-embedded them.
+
+        >>> db = ArticleDB()
+        >>> db.dense_enabled
+        True
+        >>> with db.db:
+        ...     _ = db.db.execute("INSERT INTO meta(key, value) VALUES ('embedding_model', 'all-MiniLM-L6-v2');")
+        >>> db._check_embedding_model(readonly=False)
+        >>> db._stored_embedding_model()
+        'hashed'
+        '''
+        model = embedding_model_name()
+        self.dense_enabled = self._stored_embedding_model() == model
+        if self.dense_enabled:
+            return
+        if readonly:
+            self.logger.warning(f'the embeddings in the database were not computed with {model}; dense search is disabled until the database is opened for writing')
+            return
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            if self._stored_embedding_model() != model:
+                self._reembed_articles(model)
+            self.db.execute('COMMIT;')
+        except BaseException:
+            self.db.execute('ROLLBACK;')
+            raise
+        self.dense_enabled = True
+
+    def _reembed_articles(self, model, batch_size=256):
+        '''
+        Replace the embeddings of all articles by ones computed with model.
+        The new vectors get new seq numbers, so that _VectorIndex.refresh picks them up.
+        '''
+        self.logger.info(f'recomputing the embeddings of all articles with {model}')
+        sql = '''
+        SELECT rowid, title, text, en_translation, en_summary
+        FROM articles
+        WHERE text IS NOT NULL;
+        '''
+        _logsql(sql)
+        rows = self.db.execute(sql)
+        seq = self.db.execute('SELECT coalesce(max(seq), 0) FROM vectors;').fetchone()[0]
+        sql = 'DELETE FROM vectors;'
+        _logsql(sql)
+        self.db.execute(sql)
+        sql = '''
+        INSERT INTO vectors(id, seq, vector) VALUES (?, ?, ?);
+        '''
+        _logsql(sql)
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+            vectors = embed_many([_embedding_text(row) for row in batch])
+            self.db.executemany(sql, ((row['rowid'], seq + i + 1, vector.tobytes()) for i, (row, vector) in enumerate(zip(batch, vectors))))
+            seq += len(batch)
+        sql = '''
+        INSERT OR REPLACE INTO meta(key, value) VALUES ('embedding_model', ?);
+        '''
+        _logsql(sql)
+        self.db.execute(sql, [model])
+
+    def term_idf(self, terms):
+        '''
+        Return a dictionary mapping each of terms that appears in the db to its inverse document frequency,
+        computed with the same formula as BM25.
+        Terms that don't appear in any article are not included.
+        '''
+        return _idf(self._doc_freqs(terms), len(self))
+
+    def _doc_freqs(self, terms):
+        '''
+        Return a dictionary mapping each of terms that appears in the db to the number of articles containing it.
+
+        The document frequencies are read from the articles_vocab table,
+        which looks up each term directly in the full text index.
+        '''
+        if not terms:
+            return {}
+        fts_terms = {term: _fts_term(term) for term in terms}
+        sql = f'''
+        SELECT term, doc
+        FROM articles_vocab
+        WHERE term IN ({','.join('?' * len(fts_terms))});
+        '''
+        _logsql(sql)
+        cursor = self.db.cursor()
+        cursor.execute(sql, list(set(fts_terms.values())))
+        doc_freqs = {row['term']: row['doc'] for row in cursor.fetchall()}
+        return {term: doc_freqs[fts_term] for term, fts_term in fts_terms.items() if doc_freqs.get(fts_term)}
+
+    def corpus_version(self):
+        '''
+        Return a number that increases every time articles are added to the db.
+        This is used to invalidate cached rag responses.
+        '''
+        sql = '''
+        SELECT value FROM meta WHERE key='corpus_version';
+        '''
+        _logsql(sql)
+        return self.db.execute(sql).fetchone()[0]
 
     def find_articles(self, query, limit=10, timebias_alpha=1):
         '''
         Return a list of articles in the database that match the specified query.
 
+        Retrieval is hybrid:
+        the FTS5 BM25 ranking of articles containing any of the query's words
+        is combined with a cosine similarity search over the embeddings of the articles (see the embed function)
+        using reciprocal rank fusion.
+        With the default hashed embeddings, only the dense matches with a similarity of at least DENSE_MIN_SIMILARITY are fused,
+        because weaker matches are mostly hash collisions between unrelated words.
+        Each returned article has a 'score' field containing its fused score,
+        and 'bm25' and 'similarity' fields containing its scores in each ranking (None if it was not in that ranking).
+
         Lowering the value of the timebias_alpha parameter will result in the time becoming more influential.
-        The final ranking is computed by the FTS5 rank * timebias_alpha / (days since article publication + timebias_alpha).
+        The BM25 ranking is computed by the FTS5 rank * timebias_alpha / (days since article publication + timebias_alpha).
+        Setting timebias_alpha to None disables the time bias.
         '''
-        formatted_query = f'"{query}"'
-        sql = '''
-        SELECT url, title, en_summary
+        num_candidates = max(50, 5 * limit)
+        bm25 = dict(self._bm25_search(query, num_candidates, timebias_alpha))
+        similarity = dict(self._dense_search(query, num_candidates))
+        fused = _reciprocal_rank_fusion([list(bm25), list(similarity)])[:limit]
+        if not fused:
+            return []
+
+        sql = f'''
+        SELECT rowid, url, title, publish_date, lang, text, en_translation, en_summary
         FROM articles
-        WHERE articles MATCH ?
-        ORDER BY rank
-        LIMIT ?;
+        WHERE rowid IN ({','.join('?' * len(fused))});
         '''
-        #print(sql)
-
         _logsql(sql)
         cursor = self.db.cursor()
-        cursor.execute(sql, (formatted_query, limit))
-        rows = cursor.fetchall()
+        cursor.execute(sql, [rowid for rowid, score in fused])
+        rows = {row['rowid']: row for row in cursor.fetchall()}
 
         articles = []
-        for row in rows:
-            publish_date = datetime.datetime.fromisoformat(row['publish_date'])
-            age_days = (datetime.datetime.now() - publish_date).days
-            time_bias = timebias_alpha / (age_days + timebias_alpha)
-            final_rank = row['rank'] * time_bias
-
+        for rowid, score in fused:
+            row = rows.get(rowid)
+            if row is None:
+                continue
             article = {
                 'url': row['url'],
                 'title': row['title'],
+                'publish_date': row['publish_date'],
+                'lang': row['lang'],
+                'text': row['text'],
+                'en_translation': row['en_translation'],
                 'en_summary': row['en_summary'],
+                'score': score,
+                'bm25': bm25.get(rowid),
+                'similarity': similarity.get(rowid),
             }
             articles.append(article)
-
-        articles.sort(key=lambda x: x['final_rank'], reverse=True)
-
         return articles
 
+    def _bm25_search(self, query, limit, timebias_alpha=1):
+        '''
+        Return (rowid, score) pairs for the articles with the best time-biased BM25 scores for any of the words in query,
+        best (i.e. most negative score) first.
+
+        The time bias is computed inside of sqlite as part of the ORDER BY,
+        so only the top limit rowids are ever returned to python.
+        FTS5's rank is negative (more negative is better),
+        so multiplying by the bias (which is between 0 and 1) moves older articles towards the end.
+        Articles without a (parseable) publication date are treated as if they were published when they were crawled,
+        so that undated pages do not outrank every dated article.
+
+        >>> db = ArticleDB()
+        >>> today = datetime.date.today()
+        >>> row = dict.fromkeys(['hostname', 'lang', 'en_translation', 'en_summary'])
+        >>> row.update(title='Harris accepts the nomination', text='Harris accepts the democratic nomination in Chicago.')
+        >>> db.add_articles([
+        ...     dict(row, url='https://a.com/undated', publish_date=None, crawl_date=(today - datetime.timedelta(days=60)).isoformat()),
+        ...     dict(row, url='https://a.com/dated', publish_date=(today - datetime.timedelta(days=10)).isoformat(), crawl_date=today.isoformat()),
+        ...     ])
+        2
+        >>> [db.db.execute('SELECT url FROM articles WHERE rowid=?', [rowid]).fetchone()[0] for rowid, score in db._bm25_search('Harris', 10)]
+        ['https://a.com/dated', 'https://a.com/undated']
+        '''
+        formatted_query = _fts_query(query)
+        if formatted_query is None:
+            return []
+        if timebias_alpha is None:
+            sql = '''
+            SELECT rowid, rank AS score
+            FROM articles
+            WHERE articles MATCH ?
+            ORDER BY rank
+            LIMIT ?;
+            '''
+            params = (formatted_query, limit)
+        else:
+            sql = '''
+            SELECT rowid, rank * ?3 / (
+                max(julianday('now') - coalesce(julianday(publish_date), julianday(crawl_date), julianday('now')), 0) + ?3
+                ) AS score
+            FROM articles
+            WHERE articles MATCH ?1
+            ORDER BY score
+            LIMIT ?2;
+            '''
+            params = (formatted_query, limit, timebias_alpha)
+        _logsql(sql)
+        with metrics.timer('ragnews_query_seconds', index='fts'):
+            cursor = self.db.cursor()
+            cursor.execute(sql, params)
+            return [(row[0], row[1]) for row in cursor.fetchall()]
+
+    def _dense_search(self, query, limit):
+        '''
+        Return (rowid, similarity) pairs for the articles whose embeddings are most similar to the embedding of query.
+        Articles with a similarity below dense_min_similarity() are not returned.
+        '''
+        if not self.dense_enabled:
+            return []
+        with metrics.timer('ragnews_query_seconds', index='dense'):
+            self.vector_index.refresh(self.db)
+            return self.vector_index.search(embed(query), limit, dense_min_similarity())
 
     @_catch_errors
-    def add_url(self, url, recursive_depth=0, allow_dupes=False):
+    def add_url(self, url, recursive_depth=0, allow_dupes=False, refresh=False):
         '''
         Download the url, extract various metainformation, and add the metainformation into the db.
+
+        If recursive_depth > 0, then the links on the page are added recursively by crawling with a single worker
+        (see the crawl method), so that the articles are inserted in batches instead of one transaction per article.
+
+        If refresh is True, then urls that are already in the db are downloaded again with a conditional request,
+        and the extraction and LLM stages are skipped when the page has not changed (see the _is_unchanged method).
         '''
         logging.info(f'add_url {url}')
 
-        if not allow_dupes:
+        if recursive_depth > 0:
+            self.crawl([url], recursive_depth, allow_dupes=allow_dupes, workers=1, refresh=refresh)
+            return
+
+        validators = None
+        if refresh:
+            validators = self._get_validators(url)
+        elif not allow_dupes:
             logging.debug(f'checking for url in database')
-            sql = '''
-            SELECT count(*) FROM articles WHERE url=?;
-            '''
-            _logsql(sql)
-            cursor = self.db.cursor()
-            cursor.execute(sql, [url])
-            row = cursor.fetchone()
-            is_dupe = row[0] > 0
-            if is_dupe:
+            if self._is_dupe(url):
                 logging.debug(f'duplicate detected, skipping!')
                 return
 
         logging.debug(f'downloading url')
-        try:
-            response = requests.get(url)
-        except requests.exceptions.MissingSchema:
-            url = 'https://' + url
-            response = requests.get(url)
-        parsed_uri = urlparse(url)
-        hostname = parsed_uri.netloc
+        page = _download(url, validators=validators)
+        url = page['url']
+        if self._is_unchanged(page, validators):
+            return
 
         logging.debug(f'extracting information')
-        #parsed = ragnewsmetahtml.parse(response.text, url)
-        #info = ragnewsmetahtml.simplify_meta(parsed)
+        info = _extract_info(page['html'], url)
 
-        if info['type'] != 'article' or len(info['content']['text']) < 100:
-            logging.debug(f'not an article... skipping')
-            en_translation = None
-            en_summary = None
-            info['title'] = None
-            info['content'] = {'text': None}
-            info['timestamp.published'] = {'lo': None}
-            info['language'] = None
-        else:
-            logging.debug('summarizing')
-            if not info['language'].startswith('en'):
-                en_translation = translate_text(info['content']['text'])
-            else:
-                en_translation = None
-            en_summary = summarize_text(info['content']['text'])
+        logging.debug('summarizing')
+        row = _process_info(info, url)
+        row.update(etag=page['etag'], last_modified=page['last_modified'], body_hash=page['body_hash'])
 
         logging.debug('inserting into database')
+        self.add_articles([row])
+
+    def crawl(self, urls, recursive_depth=0, allow_dupes=False, workers=8, max_per_host=2, batch_size=100, optimize=False, refresh=False, max_in_flight=None):
+        '''
+        Concurrently download the urls (and recursively the links they contain) and add them into the db.
+
+        This is the parallel version of the add_url method.
+        The work is split into pipelined stages that each run on their own pool of threads:
+        downloading, extracting metainformation, and the LLM translation/summarization.
+        Because the stages are decoupled,
+        newly discovered links get downloaded while earlier articles are still being summarized.
+        All database access (dedupe checks and inserts) happens on the calling thread,
+        so the sqlite connection is never shared between threads.
+
+        The workers parameter controls the number of concurrent downloads and LLM calls,
+        and max_per_host limits how many requests can be in flight against a single hostname at once.
+        Urls whose hostname already has max_per_host requests in flight stay queued
+        while the urls of other hostnames are downloaded, so the download threads never wait on a busy hostname.
+        Urls are normalized and deduplicated before they are queued,
+        so every url is downloaded at most once per crawl.
+        At most max_in_flight (by default 2 * workers) pages are being downloaded, extracted or summarized at any time;
+        the other queued urls wait until a page is inserted,
+        so downloads cannot run ahead of the slower LLM stage and memory use stays bounded on large crawls.
+        Processed articles are inserted in transactions of batch_size rows (see the batch method).
+        The refresh parameter has the same meaning as in add_url;
+        unchanged pages go through the extraction stage only if their links are needed.
+        '''
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        seen = set()
+        host_requests = collections.Counter()
+        stages = {}
+        # the queued urls of each hostname, in the order that they were discovered
+        frontier = collections.OrderedDict()
+        validators = {}
+        unchanged = set()
+
+        fetch_pool = ThreadPoolExecutor(workers, thread_name_prefix='fetch')
+        extract_pool = ThreadPoolExecutor(max(1, workers // 4), thread_name_prefix='extract')
+        llm_pool = ThreadPoolExecutor(workers, thread_name_prefix='llm')
+
+        def enqueue(url, depth, check_dupes):
+            url = _normalize_url(url)
+            if url in seen:
+                return
+            seen.add(url)
+            if refresh:
+                validators[url] = self._get_validators(url)
+            elif check_dupes and self._is_dupe(url):
+                logging.debug(f'duplicate detected, skipping {url}')
+                return
+            frontier.setdefault(urlparse(url).netloc, collections.deque()).append((url, depth))
+
+        def fetch():
+            for hostname in list(frontier):
+                host_queue = frontier[hostname]
+                while host_queue and host_requests[hostname] < max_per_host and len(stages) < max_in_flight:
+                    url, depth = host_queue.popleft()
+                    host_requests[hostname] += 1
+                    future = fetch_pool.submit(_download, url, validators.get(url) if depth == 0 else None)
+                    stages[future] = ('fetch', url, depth)
+                if not host_queue:
+                    del frontier[hostname]
+
+        for url in urls:
+            enqueue(url, recursive_depth, not allow_dupes)
+
+        pages = {}
+        with self.batch(batch_size, optimize=optimize) as writer:
+            try:
+                fetch()
+                while stages:
+                    done, _ = wait(stages, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage, url, depth = stages.pop(future)
+                        if stage == 'fetch':
+                            host_requests[urlparse(url).netloc] -= 1
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            metrics.inc('ragnews_errors_total', where=stage, type=type(e).__name__)
+                            logging.error(f'{stage} {url}: {e}')
+                            pages.pop(url, None)
+                            unchanged.discard(url)
+                            continue
+
+                        if stage == 'fetch':
+                            page = result
+                            if self._is_unchanged(page, validators.pop(url, None)):
+                                if depth == 0:
+                                    continue
+                                # only the links of unchanged pages are needed
+                                unchanged.add(url)
+                            else:
+                                pages[url] = {key: page[key] for key in ['etag', 'last_modified', 'body_hash']}
+                            future2 = extract_pool.submit(_extract_info, page['html'], url)
+                            stages[future2] = ('extract', url, depth)
+
+                        elif stage == 'extract':
+                            info = result
+                            if depth > 0:
+                                for url2 in _same_site_links(info, url):
+                                    enqueue(url2, depth - 1, True)
+                            if url in unchanged:
+                                unchanged.discard(url)
+                                continue
+                            future2 = llm_pool.submit(_process_info, info, url)
+                            stages[future2] = ('llm', url, depth)
+
+                        elif stage == 'llm':
+                            logging.info(f'inserting {url}')
+                            page = pages.pop(url)
+                            result.update(etag=page['etag'], last_modified=page['last_modified'], body_hash=page['body_hash'])
+                            writer.add(result)
+                    fetch()
+            finally:
+                for future in stages:
+                    future.cancel()
+                for pool in [fetch_pool, extract_pool, llm_pool]:
+                    pool.shutdown(wait=False)
+
+    def _is_dupe(self, url):
+        '''
+        Return True if the url is already stored in the database.
+        '''
         sql = '''
-        INSERT INTO articles(title, text, hostname, url, publish_date, crawl_date, lang, en_translation, en_summary)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+        SELECT count(*) FROM urls WHERE url=?;
         '''
         _logsql(sql)
         cursor = self.db.cursor()
-        cursor.execute(sql, [
-            info['title'],
-            info['content']['text'],
-            hostname,
-            url,
-            info['timestamp.published']['lo'],
-            datetime.datetime.now().isoformat(),
-            info['language'],
-            en_translation,
-            en_summary,
-        ])
-        self.db.commit()
-
-        logging.debug('recursively adding more links')
-        if recursive_depth > 0:
-            for link in info['links.all']:
-                url2 = link['href']
-                parsed_uri2 = urlparse(url2)
-                hostname2 = parsed_uri2.netloc
-                if hostname in hostname2 or hostname2 in hostname:
-                    self.add_url(url2, recursive_depth - 1)
+        cursor.execute(sql, [_normalize_url(url)])
+        row = cursor.fetchone()
+        return row[0] > 0
 
-    def __len__(self):
+    def _get_validators(self, url):
+        '''
+        Return the HTTP caching headers and body hash stored for url by its last download,
+        or None if the url is not in the database.
+        '''
         sql = '''
-        SELECT count(*)
-        FROM articles
-        WHERE text IS NOT NULL;
+        SELECT etag, last_modified, body_hash FROM urls WHERE url=?;
         '''
         _logsql(sql)
         cursor = self.db.cursor()
-        cursor.execute(sql)
-        row = cursor.fetchone()
-        return row[0]
+        cursor.execute(sql, [_normalize_url(url)])
+        return cursor.fetchone()
 
+    def _is_unchanged(self, page, validators):
+        '''
+        Return True if page (as returned by _download) is unchanged since the download that stored validators.
 
-if __name__ == '__main__':
-    import argparse
+        A page is unchanged if the server responded "304 Not Modified" to the conditional request,
+        or if the downloaded body has the same hash as before.
+        Unchanged pages only have their caching headers and crawl_date updated,
+        and do not go through the extraction and LLM stages.
+        '''
+        if validators is None:
+            return False
+        if page['html'] is not None and page['body_hash'] != validators['body_hash']:
+            return False
+        logging.debug(f"unchanged since last crawl: {page['url']}")
+        sql = '''
+        UPDATE urls
+        SET etag=coalesce(?, etag), last_modified=coalesce(?, last_modified), crawl_date=?
+        WHERE url=?;
+        '''
+        _logsql(sql)
+        with self.db:
+            self.db.execute(sql, [page['etag'], page['last_modified'], datetime.datetime.now().isoformat(), _normalize_url(page['url'])])
+        return True
+
+    def add_articles(self, rows, batch_size=100, optimize=False):
+        '''
+        Insert an iterable of rows (dictionaries as returned by _process_info) into the db.
+        Returns the number of rows inserted.
+
+        This is much faster than inserting the rows one at a time because the rows are
+        written with executemany and committed in transactions of batch_size rows.
+        '''
+        with self.batch(batch_size, optimize=optimize) as writer:
+            for row in rows:
+                writer.add(row)
+        return writer.count
+
+    @contextlib.contextmanager
+    def batch(self, batch_size=100, optimize=False):
+        '''
+        A context manager that buffers inserts into the db.
+
+        Rows are added with the add method of the returned writer
+        and every batch_size rows are committed in a single transaction.
+        Any buffered rows are committed when the context exits.
+        If optimize is True, the FTS5 index segments are merged together once all rows are written,
+        which makes subsequent queries faster but takes time proportional to the size of the db.
+        '''
+        writer = _BatchWriter(self, batch_size)
+        try:
+            yield writer
+        finally:
+            writer.flush()
+            if optimize:
+                self.optimize()
+
+    def optimize(self):
+        '''
+        Merge all of the FTS5 index segments into a single segment.
+        '''
+        sql = '''
+        INSERT INTO articles(articles) VALUES ('optimize');
+        '''
+        _logsql(sql)
+        with self.db:
+            self.db.execute(sql)
+
+    def __len__(self):
+        '''
+        Return the number of articles in the db (pages that were not articles are not counted).
+        The count is kept in the meta table by _BatchWriter.flush, so this does not scan the urls table.
+
+        >>> db = ArticleDB()
+        >>> row = dict.fromkeys(['hostname', 'publish_date', 'crawl_date', 'lang', 'en_translation', 'en_summary'])
+        >>> row.update(title='Harris accepts the nomination', text='Harris accepts the democratic nomination in Chicago.')
+        >>> db.add_articles([dict(row, url='https://a.com/1'), dict(row, url='https://a.com/2'), dict(row, url='https://a.com/1')])
+        3
+        >>> len(db)
+        2
+        >>> db.add_articles([dict(row, url='https://a.com/2', text=None), dict(row, url='https://a.com/3', text=None)])
+        2
+        >>> len(db)
+        1
+        '''
+        sql = '''
+        SELECT value FROM meta WHERE key='article_count';
+        '''
+        _logsql(sql)
+        return self.db.execute(sql).fetchone()[0]
+
+
+class ArticleDBPool:
+    '''
+    A fixed size pool of read-only ArticleDB connections to the same file,
+    used to answer concurrent queries (e.g. in ragnews.server) without serializing them on a single connection.
+    All of the connections share a single in-memory embedding matrix.
+    '''
+
+    def __init__(self, filename, size=4):
+        # open the db for writing once so that the schema is created/migrated and the db is in WAL mode
+        ArticleDB(filename).db.close()
+        vector_index = _VectorIndex()
+        self.size = size
+        self._queue = queue.Queue()
+        for _ in range(size):
+            self._queue.put(ArticleDB(filename, readonly=True, vector_index=vector_index))
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        A context manager that takes an ArticleDB from the pool (waiting if they are all in use) and returns it afterwards.
+        '''
+        db = self._queue.get()
+        try:
+            yield db
+        finally:
+            self._queue.put(db)
+
+def __getattr__(name):
+    '''
+    Make ragnews.ShardedArticleDB and ragnews.open_db available without importing ragnews.shards
+    (which builds on ArticleDB) while this file is still being imported.
+    '''
+    if name in ['ShardedArticleDB', 'open_db']:
+        from . import shards
+        return getattr(shards, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def main(argv=None):
+    '''
+    Run the command line interface described in the docstring at the top of this file.
+    '''
+    from .shards import ShardedArticleDB, open_db
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--loglevel', default='warning')
-    parser.add_argument('--db', default='ragnews.db')
+    parser.add_argument('--db', default='ragnews.db', help='The database file, or a directory of shards (see ShardedArticleDB).')
+    parser.add_argument('--shard_by', choices=ShardedArticleDB.SHARD_BY, help='Create --db as a directory of shards partitioned by hostname or publication date.')
     parser.add_argument('--recursive_depth', default=0, type=int)
-    parser.add_argument('--add_url', help='If this parameter is added, then the program will not provide an interactive QA session with the database.  Instead, the provided url will be downloaded and added to the database.')
-    args = parser.parse_args()
+    parser.add_argument('--add_url', nargs='+', default=[], help='If this parameter is added, then the program will not provide an interactive QA session with the database.  Instead, the provided urls will be downloaded and added to the database.')
+    parser.add_argument('--url_file', help='Like --add_url, but reads the urls from a file with one url per line (blank lines and lines starting with # are ignored).')
+    parser.add_argument('--llm_backend', choices=['groq', 'openai', 'fake'], help='The LLM backend to use; defaults to the RAGNEWS_LLM_BACKEND environment variable or groq.')
+    parser.add_argument('--no_stream', action='store_true', help='Print answers only once they are complete instead of as they are generated.')
+    parser.add_argument('--keyword_mode', choices=KEYWORD_MODES, help='How search keywords are computed from questions: locally (the default), by the LLM, or both; defaults to the RAGNEWS_KEYWORD_MODE environment variable or local.')
+    parser.add_argument('--no_llm_cache', action='store_true', help='Always send requests to the LLM instead of reusing cached responses.')
+    parser.add_argument('--refresh', action='store_true', help='Re-download urls already in the database with conditional requests, and only re-process the pages that changed.')
+    parser.add_argument('--workers', default=1, type=int, help='Number of concurrent downloads/LLM calls used by --add_url.  A value of 1 processes one page at a time.')
+    parser.add_argument('--batch_size', default=100, type=int, help='Number of articles inserted per transaction.')
+    parser.add_argument('--optimize', action='store_true', help='Merge the full text index into a single segment after adding urls.')
+    parser.add_argument('--max_per_host', default=2, type=int, help='Maximum number of concurrent requests to a single hostname.')
+    parser.add_argument('--max_in_flight', type=int, help='Maximum number of pages being downloaded or processed at once; defaults to twice --workers.')
+    parser.add_argument('--metrics', help='Write the timing and error metrics to this file on exit (as JSON if it ends in .json, otherwise in the Prometheus text format).')
+    parser.add_argument('--profile', nargs='?', const='-', help='Run each question (or the --add_url crawl) under cProfile, and print the slowest functions to stderr or save the profile to the given file.')
+    args = parser.parse_args(argv)
 
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
@@ -395,16 +2102,48 @@ if __name__ == '__main__':
         level=args.loglevel.upper(),
         )
 
-    db = ArticleDB(args.db)
+    if args.llm_backend:
+        set_backend(args.llm_backend)
+    if args.no_llm_cache:
+        llm_cache.enabled = False
+
+    db = open_db(args.db, shard_by=args.shard_by)
     #stores all of our articles
 
-    if args.add_url:
-        db.add_url(args.add_url, recursive_depth=args.recursive_depth, allow_dupes=True)
+    def profile():
+        if args.profile is None:
+            return contextlib.nullcontext()
+        return profiled(None if args.profile == '-' else args.profile)
 
-    else:
-        import readline
-        while True:
-            text = input('ragnews> ')
-            if len(text.strip()) > 0:
-                output = rag(text, db)
-                print(output)
+    urls = list(args.add_url)
+    if args.url_file:
+        with open(args.url_file) as fin:
+            urls += [line.strip() for line in fin if line.strip() and not line.startswith('#')]
+
+    try:
+        if args.add_url or args.url_file:
+            with profile():
+                db.crawl(urls, recursive_depth=args.recursive_depth, allow_dupes=True, workers=args.workers, max_per_host=args.max_per_host, batch_size=args.batch_size, optimize=args.optimize, refresh=args.refresh, max_in_flight=args.max_in_flight)
+
+        else:
+            import readline
+            while True:
+                text = input('ragnews> ')
+                if len(text.strip()) > 0:
+                    with profile():
+                        if args.no_stream:
+                            output = rag(text, db, keyword_mode=args.keyword_mode)
+                            print(output)
+                        else:
+                            timings = {}
+                            for chunk in rag(text, db, timings=timings, stream=True, keyword_mode=args.keyword_mode):
+                                print(chunk, end='', flush=True)
+                            print()
+                            logging.info(f'time to first token: {timings.get("ttft", 0):.3f}s')
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+'''
+Entry point for `python3 -m ragnews`.
+
+`python3 -m ragnews serve [options]` runs the HTTP query server (see ragnews.server),
+and `python3 -m ragnews ingest [options] PATH...` adds the pages stored in crawl archives to the database (see ragnews.ingest);
+any other arguments are handled by the interactive/crawling command line interface in ragnews/__init__.py.
+'''
+
+import sys
+
+if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+    from ragnews import server
+    server.main(sys.argv[2:])
+elif len(sys.argv) > 1 and sys.argv[1] == 'ingest':
+    from ragnews import ingest
+    ingest.main(sys.argv[2:])
+else:
+    import ragnews
+    ragnews.main(sys.argv[1:])
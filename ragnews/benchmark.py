@@ -0,0 +1,273 @@
+'''
+This file benchmarks the performance of ragnews on synthetic corpora.
+
+For each corpus size, it measures:
+1. ingest throughput of ArticleDB.add_articles (rows/sec),
+2. latency percentiles of ArticleDB.find_articles, and
+3. end-to-end latency of rag() using the fake LLM backend (so no network is needed).
+It also measures the startup time of new processes that import ragnews or run its command line interface.
+
+The results of each run are appended as a single JSON line to the output file,
+together with the git commit and library versions,
+so that runs can be compared across commits.
+'''
+
+import ragnews
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO
+)
+logger = logging.getLogger()
+
+
+# a small vocabulary of political news words;
+# synthetic articles draw from it with a Zipf-like distribution so that
+# some terms are very common and most are rare, like in real text
+VOCABULARY = '''
+election president campaign vote voters ballot poll polls senate house congress democrat democratic republican
+party nominee candidate debate convention governor state states county district court supreme justice law
+policy economy inflation jobs tax taxes immigration border abortion healthcare climate energy oil foreign war
+ukraine israel gaza china russia mexico trade tariff biden harris trump vance walz obama pelosi mcconnell
+administration white capitol rally speech primary caucus delegate swing pennsylvania georgia arizona michigan
+wisconsin nevada carolina florida texas california new york washington reporters interview statement
+announced said says told according officials sources week month year monday tuesday wednesday thursday friday
+'''.split()
+
+HOSTNAMES = ['apnews.com', 'www.cnn.com', 'www.foxnews.com', 'www.nytimes.com', 'elpais.com', 'www.bbc.com', 'www.npr.org']
+
+
+def _zipf_words(rng, n):
+    weights = [1 / (i + 1) for i in range(len(VOCABULARY))]
+    return rng.choices(VOCABULARY, weights=weights, k=n)
+
+
+def synthetic_rows(n, seed=0):
+    '''
+    Yield n synthetic rows suitable for ArticleDB.add_articles.
+
+    >>> rows = list(synthetic_rows(2))
+    >>> len(rows)
+    2
+    >>> sorted(rows[0].keys())
+    ['crawl_date', 'en_summary', 'en_translation', 'hostname', 'lang', 'publish_date', 'text', 'title', 'url']
+    '''
+    rng = random.Random(seed)
+    now = datetime.datetime(2024, 10, 1)
+    for i in range(n):
+        hostname = rng.choice(HOSTNAMES)
+        publish_date = now - datetime.timedelta(days=rng.randrange(730), seconds=rng.randrange(86400))
+        yield {
+            'title': ' '.join(_zipf_words(rng, 10)).capitalize(),
+            'text': ' '.join(_zipf_words(rng, 300)),
+            'hostname': hostname,
+            'url': f'https://{hostname}/article/{seed}/{i}',
+            'publish_date': publish_date.isoformat(),
+            'crawl_date': now.isoformat(),
+            'lang': 'en',
+            'en_translation': None,
+            'en_summary': ' '.join(_zipf_words(rng, 60)),
+            }
+
+
+def synthetic_queries(n, seed=1):
+    '''
+    Return n synthetic questions about the synthetic corpus.
+    '''
+    rng = random.Random(seed)
+    return [' '.join(_zipf_words(rng, rng.randrange(3, 10))) for _ in range(n)]
+
+
+def _percentiles(values):
+    '''
+    Return summary statistics of a list of latencies (in seconds).
+
+    >>> _percentiles([1, 2, 3, 4])
+    {'n': 4, 'mean': 2.5, 'p50': 3, 'p90': 4, 'p99': 4, 'max': 4}
+    '''
+    values = sorted(values)
+    if not values:
+        return {'n': 0}
+    def percentile(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {
+        'n': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': values[-1],
+        }
+
+
+def bench_ingest(db, n, batch_size=1000):
+    '''
+    Insert n synthetic articles into db and return the ingest throughput.
+    '''
+    start = time.perf_counter()
+    db.add_articles(synthetic_rows(n), batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': n,
+        'seconds': elapsed,
+        'rows_per_sec': n / elapsed,
+        }
+
+
+def bench_find_articles(db, queries, limit=10):
+    '''
+    Return the latency percentiles of running each query through db.find_articles.
+    Queries that raise an exception are counted in the errors field instead of the latencies.
+    '''
+    latencies = []
+    errors = 0
+    for query in queries:
+        start = time.perf_counter()
+        try:
+            db.find_articles(query, limit=limit)
+        except Exception as e:
+            logger.debug(f'find_articles failed: {e!r}')
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    results = _percentiles(latencies)
+    results['errors'] = errors
+    return results
+
+
+def bench_rag(db, queries):
+    '''
+    Return the latency percentiles of running each query through rag() with the fake LLM backend,
+    both end-to-end and for each stage of the pipeline.
+    The LLM and rag caches are disabled so that every call goes through retrieval and the (fake) backend.
+    '''
+    backend = ragnews.get_backend()
+    cache_enabled = ragnews.llm_cache.enabled
+    rag_cache_enabled = ragnews.rag_cache.enabled
+    ragnews.set_backend('fake')
+    ragnews.llm_cache.enabled = False
+    ragnews.rag_cache.enabled = False
+    try:
+        stages = {}
+        latencies = []
+        errors = 0
+        for query in queries:
+            timings = {}
+            start = time.perf_counter()
+            try:
+                ragnews.rag(query, db, timings=timings)
+            except Exception as e:
+                logger.debug(f'rag failed: {e!r}')
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+    finally:
+        ragnews.set_backend(backend)
+        ragnews.llm_cache.enabled = cache_enabled
+        ragnews.rag_cache.enabled = rag_cache_enabled
+    results = _percentiles(latencies)
+    results['errors'] = errors
+    results['stages'] = {stage: _percentiles(values) for stage, values in stages.items()}
+    return results
+
+
+# commands whose running time is dominated by starting python and importing ragnews
+STARTUP_COMMANDS = {
+    'import': ['-c', 'import ragnews'],
+    'cli_help': ['-m', 'ragnews', '--help'],
+    }
+
+
+def bench_startup(runs=5):
+    '''
+    Return the latency percentiles of running each of the STARTUP_COMMANDS in a new python process.
+    This is the fixed cost paid by every invocation of the command line interface.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    results = {}
+    for name, args in STARTUP_COMMANDS.items():
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            latencies.append(time.perf_counter() - start)
+        results[name] = _percentiles(latencies)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(sizes, output, num_queries=200, num_rag=20, batch_size=1000, db_dir=None, startup_runs=5):
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'startup': bench_startup(startup_runs),
+        'sizes': {},
+        }
+    logger.info(json.dumps(results['startup']))
+    queries = synthetic_queries(num_queries)
+    with tempfile.TemporaryDirectory(dir=db_dir) as tmpdir:
+        for size in sizes:
+            logger.info(f'benchmarking corpus of {size} articles')
+            db = ragnews.ArticleDB(os.path.join(tmpdir, f'bench-{size}.db'))
+            results['sizes'][size] = {
+                'ingest': bench_ingest(db, size, batch_size=batch_size),
+                'find_articles': bench_find_articles(db, queries),
+                'rag': bench_rag(db, queries[:num_rag]),
+                }
+            logger.info(json.dumps(results['sizes'][size]))
+            db.db.close()
+
+    with open(output, 'a') as fout:
+        fout.write(json.dumps(results) + '\n')
+    logger.info(f'results appended to {output}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='Comma separated list of corpus sizes to benchmark.')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSONL file that the results are appended to.')
+    parser.add_argument('--num_queries', default=200, type=int)
+    parser.add_argument('--num_rag', default=20, type=int)
+    parser.add_argument('--batch_size', default=1000, type=int)
+    parser.add_argument('--db_dir', help='Directory for the temporary benchmark databases (defaults to the system temp dir).')
+    parser.add_argument('--startup_runs', default=5, type=int, help='Number of times each startup command is timed.')
+    args = parser.parse_args()
+
+    main(
+        [int(size) for size in args.sizes.split(',')],
+        args.output,
+        num_queries=args.num_queries,
+        num_rag=args.num_rag,
+        batch_size=args.batch_size,
+        db_dir=args.db_dir,
+        startup_runs=args.startup_runs,
+        )
@@ -3,10 +3,14 @@ This file is for evaluating the quality of our RAG system using the Hairy Trumpe
 '''
 
 import ragnews
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 import logging
 import argparse
-from sklearn.metrics import accuracy_score
+import os
+import threading
+import time
 
 # Setting up logging
 logging.basicConfig(
@@ -18,12 +22,25 @@ logger = logging.getLogger()
 
 class RAGEvaluator:
     # Specifying valid labels to predict with __init__ function
-    def __init__(self, labels):
+    def __init__(self, labels, db_path='ragnews.db'):
         self.valid_labels = labels
-        self.db = ragnews.ArticleDB('ragnews.db')
+        self.db_path = db_path
+        self._local = threading.local()
+        self._vector_index = ragnews._VectorIndex()
+
+    @property
+    def db(self):
+        '''
+        sqlite connections cannot be shared between threads,
+        so each thread that calls predict gets its own ArticleDB;
+        they all share one in-memory embedding index, like the connections of an ArticleDBPool.
+        '''
+        if not hasattr(self._local, 'db'):
+            self._local.db = ragnews.ArticleDB(self.db_path, vector_index=self._vector_index)
+        return self._local.db
 
     # Creating predictor part of the class
-    def predict(self, masked_text):
+    def predict(self, masked_text, timings=None):
         '''
         >>> model = RAGEvaluator()
         >>> model.predict('There is no mask token here')
@@ -51,11 +68,72 @@ OUTPUT:'Harris, Trump'
 
 INPUT: {masked_text}
 OUTPUT: '''
-        output = ragnews.rag(textprompt, self.db, keywords_text=masked_text)
+        output = ragnews.rag(textprompt, self.db, keywords_text=masked_text, timings=timings)
         return output
 
+def _text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _parse_prediction(output):
+    '''
+    Split the output of RAGEvaluator.predict into the list of predicted words, one for each mask.
+
+    >>> _parse_prediction("'Harris, Trump'")
+    ['Harris', 'Trump']
+    >>> _parse_prediction('Biden')
+    ['Biden']
+    >>> _parse_prediction('')
+    []
+    '''
+    words = (word.strip('\'".') for word in (output or '').replace(',', ' ').split())
+    return [word for word in words if word]
+
+
+def _accuracy(labels, predictions):
+    '''
+    Return the fraction of datapoints whose predicted words exactly match their masks
+    (the same as sklearn.metrics.accuracy_score, without importing scikit-learn).
+    Both arguments contain one list of words per datapoint.
+
+    >>> _accuracy([['Trump'], ['Harris', 'Walz']], [['Trump'], ['Harris']])
+    0.5
+    >>> _accuracy([['Trump'], ['Harris', 'Walz']], [['Trump', 'Harris', 'Walz']])
+    Traceback (most recent call last):
+        ...
+    ValueError: 2 labels but 1 predictions
+    '''
+    if len(labels) != len(predictions):
+        raise ValueError(f'{len(labels)} labels but {len(predictions)} predictions')
+    if not labels:
+        return 0.0
+    correct = sum(list(label) == list(prediction) for label, prediction in zip(labels, predictions))
+    return correct / len(labels)
+
+
+def _load_checkpoint(checkpoint, masked_texts):
+    '''
+    Return a dictionary mapping the index of each already evaluated masked text to its checkpoint record.
+    Records that do not match the current data file are ignored.
+    '''
+    results = {}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return results
+    with open(checkpoint) as fin:
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be truncated if the previous run was killed mid-write
+                continue
+            i = record['index']
+            if i < len(masked_texts) and record['hash'] == _text_hash(masked_texts[i]):
+                results[i] = record
+    return results
+
+
 #Evaluating rag function with hairy-trumpet data set
-def main(data_file):
+def main(data_file, workers=4, checkpoint=None):
     labels = []  
     masked_texts = []
 
@@ -64,37 +142,84 @@ def main(data_file):
         for line in fin:
             dp = json.loads(line)
             masks = dp['masks']
-            labels.extend(masks) 
+            labels.append(masks)
             masked_texts.append(dp['masked_text'])
 
     logger.info(f'Extracted labels: {labels}')
 
-    evaluator = RAGEvaluator(labels)
+    evaluator = RAGEvaluator([label for masks in labels for label in masks])
+
+    # Resuming from the checkpoint file (if any),
+    # then predicting the remaining labels in parallel;
+    # every finished prediction is appended to the checkpoint file immediately
+    results = _load_checkpoint(checkpoint, masked_texts)
+    todo = [i for i in range(len(masked_texts)) if i not in results]
+    logger.info(f'{len(results)} predictions loaded from checkpoint, {len(todo)} remaining')
+
+    def evaluate_one(i):
+        timings = {}
+        start = time.perf_counter()
+        prediction = evaluator.predict(masked_texts[i], timings=timings)
+        timings['total'] = time.perf_counter() - start
+        return {
+            'index': i,
+            'hash': _text_hash(masked_texts[i]),
+            'prediction': prediction,
+            'timings': timings,
+            }
+
+    # a failed prediction does not stop the others,
+    # so that every prediction that succeeds is checkpointed before the first error is re-raised
+    start = time.perf_counter()
+    errors = []
+    fout = open(checkpoint, 'a') if checkpoint else None
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(evaluate_one, i): i for i in todo}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error(f'prediction {futures[future]} failed: {e!r}')
+                    errors.append(e)
+                    continue
+                results[record['index']] = record
+                if fout:
+                    fout.write(json.dumps(record) + '\n')
+                    fout.flush()
+                logger.debug(f'finished {len(results)}/{len(masked_texts)}')
+    finally:
+        if fout:
+            fout.close()
+    elapsed = time.perf_counter() - start
+    if errors:
+        logger.error(f'{len(errors)} predictions failed; rerun with the same checkpoint to retry them')
+        raise errors[0]
 
     # Predicting labels
-    predicted_labels = []
-    for masked_text in masked_texts:
-        prediction = evaluator.predict(masked_text)
-        if prediction: 
-            predicted_labels.append(prediction)
-        else:
-            predicted_labels.append([])
-
-    labels_flat = labels
+    predicted_labels = [_parse_prediction(results[i]['prediction']) for i in range(len(masked_texts))]
 
     print("predicted labels = ", predicted_labels)
-    print("labels =", labels_flat)
+    print("labels =", labels)
+
+    # Reporting the time spent in each stage of the pipeline
+    new_records = [results[i] for i in todo]
+    if new_records:
+        for stage in ['keywords', 'retrieval', 'generation', 'total']:
+            values = [record['timings'].get(stage, 0) for record in new_records]
+            logger.info(f'Timing {stage}: mean={sum(values) / len(values):.3f}s max={max(values):.3f}s')
+        logger.info(f'Throughput: {len(new_records) / elapsed:.2f} predictions/s ({len(new_records)} predictions in {elapsed:.1f}s with {workers} workers)')
 
     # Calculating accuracy
-    accuracy = accuracy_score(labels_flat, predicted_labels)
+    accuracy = _accuracy(labels, predicted_labels)
     logger.info(f'Accuracy: {accuracy:.2f}')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate RAG system using Hairy Trumpet dataset.')
     parser.add_argument('path', type=str, help='ragnews/hairy-trumpet')
+    parser.add_argument('--workers', type=int, default=4, help='Number of predictions to run concurrently.')
+    parser.add_argument('--checkpoint', help='JSONL file where predictions are saved as they finish; an interrupted run with the same checkpoint file resumes where it stopped.')
     args = parser.parse_args()
 
-    main(args.path)  # Passing args.path to the main function
-
-
+    main(args.path, workers=args.workers, checkpoint=args.checkpoint)  # Passing args.path to the main function
@@ -0,0 +1,370 @@
+'''
+Rebuild a ragnews database from stored crawl archives instead of downloading the pages again.
+
+Run it with:
+
+    $ python3 -m ragnews ingest --db=ragnews.db crawl-2024-09.warc.gz pages.jsonl.gz dumps/
+
+The following inputs are supported:
+
+    *.warc, *.warc.gz       WARC archives; every successful HTML response record is ingested
+    *.jsonl, *.jsonl.gz     one JSON object per line, either a downloaded page ({"url": ..., "html": ...})
+                            or an already processed row of the articles table ({"url": ..., "title": ..., "text": ..., ...})
+    directories             every file above inside the directory (recursively),
+                            and *.html files laid out as hostname/path (as `wget --mirror` creates them)
+
+Pages go through the same metainformation extraction and LLM translation/summarization stages as ArticleDB.add_url,
+and the resulting rows are written with ArticleDB.batch.
+Records are read lazily by generators and at most max_in_flight records are being processed at any time,
+so memory use does not depend on the size of the archives.
+Progress and throughput are logged periodically.
+'''
+
+import ragnews
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+ROW_FIELDS = ['title', 'text', 'hostname', 'url', 'publish_date', 'crawl_date', 'lang', 'en_translation', 'en_summary']
+
+
+################################################################################
+# readers
+################################################################################
+
+def _open(path):
+    '''
+    Open path for reading bytes, transparently decompressing .gz files.
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _parse_headers(lines):
+    headers = {}
+    for line in lines:
+        if b':' in line:
+            key, value = line.split(b':', 1)
+            headers[key.strip().decode('latin-1').lower()] = value.strip().decode('latin-1')
+    return headers
+
+
+def _dechunk(body):
+    '''
+    Decode an HTTP body that was sent with Transfer-Encoding: chunked.
+
+    >>> _dechunk(b'5\\r\\nhello\\r\\n6\\r\\n world\\r\\n0\\r\\n\\r\\n')
+    b'hello world'
+    '''
+    chunks = []
+    pos = 0
+    while True:
+        end = body.find(b'\r\n', pos)
+        if end < 0:
+            break
+        size = int(body[pos:end].split(b';')[0] or b'0', 16)
+        if size == 0:
+            break
+        chunks.append(body[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b''.join(chunks)
+
+
+def _parse_http_response(block):
+    '''
+    Return the status code, headers, and decoded body of the raw HTTP response stored in a WARC response record.
+    '''
+    head, _, body = block.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    status = int(lines[0].split()[1])
+    headers = _parse_headers(lines[1:])
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        body = _dechunk(body)
+    if headers.get('content-encoding', '').lower() in ['gzip', 'deflate']:
+        body = zlib.decompress(body, zlib.MAX_WBITS | 32)
+    return status, headers, body
+
+
+def _charset(content_type):
+    '''
+    >>> _charset('text/html; charset=ISO-8859-1')
+    'ISO-8859-1'
+    >>> _charset('text/html')
+    'utf-8'
+    '''
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return value.strip('"\'')
+    return 'utf-8'
+
+
+def _decode(body, charset):
+    try:
+        return body.decode(charset, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+def read_warc(path):
+    '''
+    Yield a page dictionary (like the ones returned by ragnews._download) for every HTML response in the WARC file at path.
+    Only one record is held in memory at a time.
+    Gzipped WARC files (including ones where every record is a separate gzip member) are supported.
+    '''
+    with _open(path) as fin:
+        while True:
+            line = fin.readline()
+            if not line:
+                break
+            if not line.startswith(b'WARC/'):
+                continue
+            header_lines = []
+            while True:
+                line = fin.readline()
+                if line in [b'\r\n', b'\n', b'']:
+                    break
+                header_lines.append(line.rstrip(b'\r\n'))
+            headers = _parse_headers(header_lines)
+            block = fin.read(int(headers.get('content-length', 0)))
+
+            if headers.get('warc-type') != 'response' or 'warc-target-uri' not in headers:
+                continue
+            try:
+                status, http_headers, body = _parse_http_response(block)
+            except (ValueError, IndexError, zlib.error) as e:
+                logger.warning(f'{path}: unparseable response for {headers["warc-target-uri"]}: {e}')
+                continue
+            content_type = http_headers.get('content-type', '')
+            if status != 200 or 'html' not in content_type.lower():
+                continue
+            html = _decode(body, _charset(content_type))
+            yield {
+                'url': headers['warc-target-uri'].strip('<>'),
+                'html': html,
+                'etag': http_headers.get('etag'),
+                'last_modified': http_headers.get('last-modified'),
+                'body_hash': ragnews._content_hash(html),
+                'crawl_date': headers.get('warc-date'),
+                }
+
+
+def read_jsonl(path):
+    '''
+    Yield the JSON object on each line of the (possibly gzipped) file at path.
+    '''
+    with _open(path) as fin:
+        for i, line in enumerate(fin):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f'{path}:{i + 1}: invalid JSON: {e}')
+
+
+def read_html_file(path, root):
+    '''
+    Return a page dictionary for an HTML file stored at hostname/path below root.
+    '''
+    with open(path, 'rb') as fin:
+        html = _decode(fin.read(), 'utf-8')
+    url = 'https://' + os.path.relpath(path, root).replace(os.sep, '/')
+    return {
+        'url': url,
+        'html': html,
+        'etag': None,
+        'last_modified': None,
+        'body_hash': ragnews._content_hash(html),
+        }
+
+
+def read_records(path):
+    '''
+    Yield the records stored at path, which can be a WARC file, a JSONL file, or a directory of such files.
+    '''
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                if filename.endswith(('.html', '.htm')):
+                    yield read_html_file(filepath, path)
+                elif filename.endswith(('.warc', '.warc.gz', '.jsonl', '.jsonl.gz')):
+                    yield from read_records(filepath)
+    elif path.endswith(('.warc', '.warc.gz')):
+        yield from read_warc(path)
+    elif path.endswith(('.jsonl', '.jsonl.gz')):
+        yield from read_jsonl(path)
+    else:
+        raise ValueError(f'unsupported input {path}; expected a .warc, .warc.gz, .jsonl, or .jsonl.gz file or a directory')
+
+
+################################################################################
+# pipeline
+################################################################################
+
+def process_record(record):
+    '''
+    Convert a record into a row of the articles table.
+
+    Downloaded pages (records with an 'html' field) go through the same extraction and LLM stages as ArticleDB.add_url.
+    Records that are already rows are returned unchanged (with any missing fields set to None).
+    '''
+    if 'html' not in record:
+        return {field: record.get(field) for field in ROW_FIELDS}
+    url = record['url']
+    info = ragnews._extract_info(record['html'], url)
+    row = ragnews._process_info(info, url)
+    row.update(
+        etag=record.get('etag'),
+        last_modified=record.get('last_modified'),
+        body_hash=record.get('body_hash') or ragnews._content_hash(record['html']),
+        )
+    if record.get('crawl_date'):
+        row['crawl_date'] = record['crawl_date']
+    return row
+
+
+class Progress:
+    '''
+    Counts the records handled by ingest and periodically logs the counts and the throughput.
+    '''
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.counts = {'read': 0, 'inserted': 0, 'skipped': 0, 'errors': 0}
+        self.start = self.last_report = time.perf_counter()
+
+    def add(self, key):
+        self.counts[key] += 1
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start
+        return dict(
+            self.counts,
+            seconds=elapsed,
+            records_per_sec=self.counts['read'] / elapsed if elapsed else 0.0,
+            )
+
+    def report(self):
+        stats = self.stats()
+        logger.info(
+            f'read={stats["read"]} inserted={stats["inserted"]} skipped={stats["skipped"]} errors={stats["errors"]} '
+            f'({stats["records_per_sec"]:.1f} records/sec)'
+            )
+
+
+def ingest(db, records, workers=8, max_in_flight=None, batch_size=100, allow_dupes=False, optimize=False, progress_interval=10):
+    '''
+    Process an iterable of records (see read_records) and insert the resulting rows into db.
+    Returns a dictionary of counts and throughput (see Progress.stats).
+
+    The records are processed (see process_record) on a pool of workers threads,
+    but at most max_in_flight (by default 2 * workers) records are read ahead of the database writes,
+    so that memory use is bounded no matter how many records there are.
+    All database access happens on the calling thread,
+    and rows are inserted in transactions of batch_size rows (see ArticleDB.batch).
+    Records whose url is already in db are skipped unless allow_dupes is True.
+    '''
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    progress = Progress(progress_interval)
+    in_flight = {}
+
+    def collect(futures):
+        for future in futures:
+            url = in_flight.pop(future)
+            try:
+                row = future.result()
+            except Exception as e:
+                ragnews.metrics.inc('ragnews_errors_total', where='ingest', type=type(e).__name__)
+                logger.error(f'{url}: {e!r}')
+                progress.add('errors')
+                continue
+            writer.add(row)
+            progress.add('inserted')
+
+    pool = ThreadPoolExecutor(workers, thread_name_prefix='ingest')
+    try:
+        with db.batch(batch_size, optimize=optimize) as writer:
+            for record in records:
+                progress.add('read')
+                url = record.get('url')
+                if not url:
+                    logger.warning('skipping record without a url')
+                    progress.add('skipped')
+                    continue
+                if not allow_dupes and db._is_dupe(url):
+                    logger.debug(f'duplicate detected, skipping {url}')
+                    progress.add('skipped')
+                    continue
+                while len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[pool.submit(process_record, record)] = url
+            collect(list(in_flight))
+    finally:
+        for future in in_flight:
+            future.cancel()
+        pool.shutdown(wait=False)
+    progress.report()
+    return progress.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='WARC files, JSONL files, or directories to ingest.')
+    parser.add_argument('--loglevel', default='info')
+    parser.add_argument('--db', default='ragnews.db', help='The database file, or a directory of shards (see ragnews.ShardedArticleDB).')
+    parser.add_argument('--shard_by', choices=ragnews.ShardedArticleDB.SHARD_BY, help='Create --db as a directory of shards partitioned by hostname or publication date.')
+    parser.add_argument('--workers', default=8, type=int, help='Number of records processed (extraction and LLM calls) concurrently.')
+    parser.add_argument('--max_in_flight', type=int, help='Maximum number of records read ahead of the database writes; defaults to twice --workers.')
+    parser.add_argument('--batch_size', default=100, type=int, help='Number of articles inserted per transaction.')
+    parser.add_argument('--allow_dupes', action='store_true', help='Re-process records whose url is already in the database.')
+    parser.add_argument('--optimize', action='store_true', help='Merge the full text index into a single segment after ingesting.')
+    parser.add_argument('--progress_interval', default=10, type=float, help='Seconds between progress reports.')
+    parser.add_argument('--metrics', help='Write the timing and error metrics to this file when done (as JSON if it ends in .json, otherwise in the Prometheus text format).')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=args.loglevel.upper(),
+        )
+
+    def records():
+        for path in args.paths:
+            logger.info(f'ingesting {path}')
+            yield from read_records(path)
+
+    db = ragnews.open_db(args.db, shard_by=args.shard_by)
+    ingest(
+        db,
+        records(),
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        batch_size=args.batch_size,
+        allow_dupes=args.allow_dupes,
+        optimize=args.optimize,
+        progress_interval=args.progress_interval,
+        )
+    if args.metrics:
+        ragnews.metrics.dump(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,847 @@
+'''
+Access to the LLM APIs and the LLM based text processing used by ragnews.
+
+Requests go through a persistent cache of responses (LLMCache) and a scheduler that keeps them under the API's rate limits (LLMScheduler).
+Long texts are split into chunks that are translated or summarized concurrently.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, Future
+import hashlib
+import heapq
+import itertools
+import json
+import random
+import logging
+import re
+import sqlite3
+import threading
+import time
+import os
+
+from .monitoring import metrics
+
+
+################################################################################
+# LLM backends
+################################################################################
+
+def _record_usage(backend, usage):
+    '''
+    Count the tokens reported in the usage field of an LLM API response.
+    The usage is an object when it comes from the groq client and a dictionary when it comes from JSON.
+    '''
+    if usage is None:
+        return
+    for kind in ['prompt', 'completion']:
+        if isinstance(usage, dict):
+            tokens = usage.get(f'{kind}_tokens')
+        else:
+            tokens = getattr(usage, f'{kind}_tokens', None)
+        if tokens:
+            metrics.inc('ragnews_llm_tokens_total', tokens, backend=backend, kind=kind)
+
+
+class GroqBackend:
+    '''
+    Sends LLM requests to the Groq API.
+
+    The groq module is imported and the client is created the first time a request is made,
+    so the GROQ_API_KEY environment variable is only needed when the LLM is actually used.
+    '''
+    name = 'groq'
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from groq import Groq
+            self._client = Groq(
+                api_key=self.api_key or os.environ.get("GROQ_API_KEY"),
+            )
+        return self._client
+
+    def complete(self, system, user, model, seed, temperature):
+        chat_completion = self.client.chat.completions.create(
+            temperature = temperature,
+            messages=[
+                {
+                    'role': 'system',
+                    'content': system,
+                },
+                {
+                    "role": "user",
+                    "content": user,
+                }
+            ],
+            model=model,
+            seed=seed if seed is not None else None
+            #seed allows for deterministic results
+        )
+        _record_usage(self.name, chat_completion.usage)
+        return chat_completion.choices[0].message.content
+
+    def stream(self, system, user, model, seed, temperature):
+        stream = self.client.chat.completions.create(
+            temperature = temperature,
+            messages=[
+                {
+                    'role': 'system',
+                    'content': system,
+                },
+                {
+                    "role": "user",
+                    "content": user,
+                }
+            ],
+            model=model,
+            seed=seed,
+            stream=True,
+        )
+        for chunk in stream:
+            # groq reports the token usage in the last chunk of the stream
+            x_groq = getattr(chunk, 'x_groq', None)
+            if x_groq is not None:
+                _record_usage(self.name, getattr(x_groq, 'usage', None))
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                yield content
+
+
+class OpenAIBackend:
+    '''
+    Sends LLM requests to any server that implements the OpenAI chat completions HTTP API
+    (e.g. OpenAI itself, vLLM, llama.cpp's server, or Ollama).
+
+    The endpoint is configured with the RAGNEWS_OPENAI_BASE_URL and OPENAI_API_KEY environment variables.
+    Because the models served by these endpoints usually have different names than the Groq models,
+    setting RAGNEWS_OPENAI_MODEL overrides the model requested by the caller.
+    '''
+
+    def __init__(self, base_url=None, api_key=None, model=None):
+        self.base_url = (base_url or os.environ.get('RAGNEWS_OPENAI_BASE_URL', 'https://api.openai.com/v1')).rstrip('/')
+        self.api_key = api_key or os.environ.get('OPENAI_API_KEY')
+        self.model = model or os.environ.get('RAGNEWS_OPENAI_MODEL')
+        self.name = f'openai:{self.base_url}'
+
+    def _post(self, system, user, model, seed, temperature, stream):
+        headers = {}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        payload = {
+            'model': self.model or model,
+            'temperature': temperature,
+            'messages': [
+                {'role': 'system', 'content': system},
+                {'role': 'user', 'content': user},
+            ],
+            'stream': stream,
+        }
+        if seed is not None:
+            payload['seed'] = seed
+        response = _get_session().post(f'{self.base_url}/chat/completions', json=payload, headers=headers, timeout=300, stream=stream)
+        response.raise_for_status()
+        return response
+
+    def complete(self, system, user, model, seed, temperature):
+        response = self._post(system, user, model, seed, temperature, stream=False)
+        data = response.json()
+        _record_usage(self.name, data.get('usage'))
+        return data['choices'][0]['message']['content']
+
+    def stream(self, system, user, model, seed, temperature):
+        # the response is a sequence of server-sent events of the form "data: {json}"
+        response = self._post(system, user, model, seed, temperature, stream=True)
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                _record_usage(self.name, event.get('usage'))
+                if not event.get('choices'):
+                    continue
+                content = event['choices'][0]['delta'].get('content')
+                if content:
+                    yield content
+
+
+class FakeBackend:
+    '''
+    A local stand-in for an LLM that needs no network or API key.
+
+    Responses are deterministic functions of the request:
+    they consist of response_words words sampled from the user prompt using a seed derived from the whole request.
+    Because the words come from the prompt, the "keywords" returned for a question are words of that question,
+    so retrieval over the resulting keywords behaves sensibly in benchmarks.
+    Every request sleeps for latency seconds to simulate the time spent waiting on a real API.
+
+    >>> backend = FakeBackend()
+    >>> backend.complete('system', 'who is the democratic nominee', 'model', None, .5) == backend.complete('system', 'who is the democratic nominee', 'model', None, .5)
+    True
+    '''
+    name = 'fake'
+
+    def __init__(self, latency=0.0, response_words=20):
+        self.latency = latency
+        self.response_words = response_words
+
+    def complete(self, system, user, model, seed, temperature):
+        if self.latency:
+            time.sleep(self.latency)
+        words = re.findall(r'\w+', user) or ['empty']
+        rng = random.Random(LLMCache.key(system, user, model, seed))
+        return ' '.join(rng.choice(words) for _ in range(self.response_words))
+
+    def stream(self, system, user, model, seed, temperature):
+        words = self.complete(system, user, model, seed, temperature).split(' ')
+        for i, word in enumerate(words):
+            yield word if i == 0 else ' ' + word
+
+
+def make_backend(name=None):
+    '''
+    Create the LLM backend with the given name ("groq", "openai", or "fake").
+    If name is None, the RAGNEWS_LLM_BACKEND environment variable is used, defaulting to "groq".
+    The latency of the fake backend is set by the RAGNEWS_FAKE_LATENCY environment variable (in seconds).
+    '''
+    name = name or os.environ.get('RAGNEWS_LLM_BACKEND', 'groq')
+    if name == 'groq':
+        return GroqBackend()
+    if name == 'openai':
+        return OpenAIBackend()
+    if name == 'fake':
+        return FakeBackend(latency=float(os.environ.get('RAGNEWS_FAKE_LATENCY', 0)))
+    raise ValueError(f'unknown LLM backend: {name}')
+
+
+_backend = None
+
+
+def get_backend():
+    '''
+    Return the backend that run_llm uses, creating it on first use.
+    '''
+    global _backend
+    if _backend is None:
+        _backend = make_backend()
+    return _backend
+
+
+def set_backend(backend):
+    '''
+    Change the backend that run_llm uses.
+    The backend can be either a backend object or the name of a backend (see make_backend).
+    '''
+    global _backend
+    if isinstance(backend, str):
+        backend = make_backend(backend)
+    _backend = backend
+
+
+class LLMCache:
+    '''
+    A persistent cache of LLM responses backed by sqlite3.
+
+    Responses are keyed on a hash of everything that determines the output of the LLM
+    (the model, the prompts, the seed, and the temperature),
+    so repeated questions and re-runs of an evaluation do not need any network calls.
+    Entries older than ttl seconds are ignored (None means entries never expire),
+    and once the cache holds more than max_entries responses the least recently used ones are evicted.
+
+    >>> cache = LLMCache(':memory:', max_entries=2)
+    >>> cache.get('a')
+    >>> cache.put('a', 'response a')
+    >>> cache.get('a')
+    'response a'
+    >>> cache.put('b', 'response b')
+    >>> cache.put('c', 'response c')
+    >>> cache.get('b')
+    'response b'
+    >>> cache.stats()
+    {'hits': 2, 'misses': 1, 'hit_rate': 0.6666666666666666, 'entries': 2}
+    '''
+
+    def __init__(self, filename, ttl=None, max_entries=100000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._entries = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        '''
+        Open the database the first time the cache is used.
+        '''
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            sql = '''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+                );
+            '''
+            self._db.execute(sql)
+            sql = '''
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+            '''
+            self._db.execute(sql)
+            self._db.commit()
+            self._entries = self._db.execute('SELECT count(*) FROM responses;').fetchone()[0]
+        return self._db
+
+    @staticmethod
+    def key(*args):
+        '''
+        Return the cache key for the input arguments.
+        '''
+        return hashlib.sha256(json.dumps(args).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Return the cached response for key, or None if there is no (unexpired) response.
+        '''
+        with self._lock:
+            db = self._connect()
+            now = time.time()
+            row = db.execute('SELECT response, created FROM responses WHERE key=?;', [key]).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            with db:
+                db.execute('UPDATE responses SET accessed=? WHERE key=?;', [now, key])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        '''
+        Store the response for key, evicting the least recently used entries if the cache is full.
+        '''
+        with self._lock:
+            db = self._connect()
+            now = time.time()
+            with db:
+                exists = db.execute('SELECT count(*) FROM responses WHERE key=?;', [key]).fetchone()[0]
+                db.execute('''
+                    INSERT OR REPLACE INTO responses(key, response, created, accessed) VALUES (?, ?, ?, ?);
+                    ''', [key, response, now, now])
+                if not exists:
+                    self._entries += 1
+                if self._entries > self.max_entries:
+                    db.execute('''
+                        DELETE FROM responses WHERE key IN (
+                            SELECT key FROM responses ORDER BY accessed LIMIT ?
+                            );
+                        ''', [self._entries - self.max_entries])
+                    self._entries = self.max_entries
+
+    def stats(self):
+        '''
+        Return a dictionary with the hit/miss counters of the cache.
+        '''
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': self._entries,
+            }
+
+    def clear(self):
+        '''
+        Remove all entries from the cache.
+        '''
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute('DELETE FROM responses;')
+            self._entries = 0
+
+
+def _make_llm_cache():
+    '''
+    Create the LLM cache from the RAGNEWS_LLM_CACHE* environment variables.
+    Setting RAGNEWS_LLM_CACHE to an empty string or "off" disables the cache.
+    '''
+    filename = os.environ.get('RAGNEWS_LLM_CACHE', 'llm_cache.db')
+    ttl = os.environ.get('RAGNEWS_LLM_CACHE_TTL')
+    max_entries = os.environ.get('RAGNEWS_LLM_CACHE_SIZE', 100000)
+    cache = LLMCache(
+        filename or ':memory:',
+        ttl=float(ttl) if ttl else None,
+        max_entries=int(max_entries),
+        )
+    cache.enabled = filename not in ['', 'off']
+    return cache
+
+
+llm_cache = _make_llm_cache()
+
+
+def _is_rate_limit_error(e):
+    '''
+    Return True if the exception was caused by the LLM API rejecting a request for exceeding the rate limit.
+    '''
+    status_code = getattr(e, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status_code == 429 or type(e).__name__ == 'RateLimitError'
+
+
+def _retry_after(e):
+    '''
+    Return the number of seconds the API asked us to wait before retrying, or None.
+    '''
+    response = getattr(e, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    '''
+    Every LLM request made by run_llm and run_llm_stream goes through the module level llm_scheduler,
+    which keeps the request rate within the limits of the provider.
+
+    Rate limiting uses two token buckets,
+    one for requests_per_minute and one for tokens_per_minute (prompt plus completion tokens, see _estimate_tokens);
+    a limit of None means unlimited.
+    Requests wait in a priority queue until both buckets have enough capacity,
+    and 'interactive' requests (rag answers) are always started before 'background' requests (summaries and translations),
+    so that a crawl never stalls a user's question.
+
+    When the API still responds with a rate limit error (429),
+    all requests are paused for the time the API asks for (or a jittered exponential backoff),
+    and the request is retried up to max_retries times instead of failing.
+
+    Identical background requests that are in flight at the same time (e.g. the same article found by two crawls)
+    are coalesced into a single API request whose response is shared.
+
+    >>> scheduler = LLMScheduler(requests_per_minute=600)
+    >>> scheduler.submit(lambda: 'response', tokens=10)
+    'response'
+    >>> scheduler.stats()['requests']
+    1
+    '''
+
+    PRIORITIES = {'interactive': 0, 'background': 1}
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=6, max_backoff=60):
+        self.limits = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.available = {name: limit for name, limit in self.limits.items() if limit is not None}
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.seq = itertools.count()
+        self.in_flight = {}
+        self.counts = {'requests': 0, 'retries': 0, 'coalesced': 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for name in self.available:
+            limit = self.limits[name]
+            self.available[name] = min(limit, self.available[name] + elapsed * limit / 60)
+
+    def _wait_time(self, tokens):
+        '''
+        Return the number of seconds until the buckets have room for a request of the given number of tokens.
+        '''
+        needed = {'requests': 1, 'tokens': tokens}
+        wait_time = self.paused_until - time.monotonic()
+        for name, available in self.available.items():
+            # a request larger than the whole bucket only has to wait for a full bucket
+            amount = min(needed[name], self.limits[name])
+            if available < amount:
+                wait_time = max(wait_time, (amount - available) * 60 / self.limits[name])
+        return wait_time
+
+    def acquire(self, tokens, priority='interactive'):
+        '''
+        Wait until a request of the given number of tokens may be sent, and take its capacity from the buckets.
+        '''
+        entry = (self.PRIORITIES[priority], next(self.seq))
+        start = time.perf_counter()
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    if self.waiting[0] == entry:
+                        wait_time = self._wait_time(tokens)
+                        if wait_time <= 0:
+                            break
+                        self.condition.wait(wait_time)
+                    else:
+                        self.condition.wait()
+                if 'requests' in self.available:
+                    self.available['requests'] -= 1
+                if 'tokens' in self.available:
+                    self.available['tokens'] -= min(tokens, self.limits['tokens'])
+                self.counts['requests'] += 1
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+        metrics.observe('ragnews_llm_queue_seconds', time.perf_counter() - start, priority=priority)
+
+    def charge(self, tokens):
+        '''
+        Take tokens that were used but not known in advance (i.e. the completion) from the token bucket.
+        '''
+        with self.condition:
+            if 'tokens' in self.available:
+                self._refill()
+                self.available['tokens'] -= tokens
+
+    def pause(self, seconds):
+        '''
+        Stop sending any requests for the given number of seconds.
+        '''
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def submit(self, func, tokens, priority='interactive', key=None):
+        '''
+        Call func (which sends one request of about tokens prompt tokens) once the rate limits allow it,
+        and return its result.
+        Rate limit errors are retried with backoff.
+
+        If key is not None and a background request with the same key is already in flight,
+        then func is not called and the result of the in-flight request is returned instead.
+        '''
+        if key is None or priority != 'background':
+            return self._call(func, tokens, priority)
+        with self.condition:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.counts['coalesced'] += 1
+        if not owner:
+            metrics.inc('ragnews_llm_coalesced_total')
+            return future.result()
+        try:
+            result = self._call(func, tokens, priority)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # also on KeyboardInterrupt and the like, so that the coalesced callers do not wait forever
+            future.set_exception(e)
+            raise
+        finally:
+            with self.condition:
+                del self.in_flight[key]
+
+    def _call(self, func, tokens, priority):
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                result = func()
+            except Exception as e:
+                if not _is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                delay = _retry_after(e) or min(self.max_backoff, 2 ** attempt) * (0.5 + random.random())
+                logging.warning(f'LLM rate limited, pausing requests for {delay:.1f}s')
+                metrics.inc('ragnews_llm_retries_total', priority=priority)
+                with self.condition:
+                    self.counts['retries'] += 1
+                self.pause(delay)
+                continue
+            if isinstance(result, str):
+                self.charge(_estimate_tokens(result))
+            return result
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts, waiting=len(self.waiting), in_flight=len(self.in_flight))
+
+
+def _make_llm_scheduler():
+    '''
+    Create the LLM scheduler from the RAGNEWS_LLM_RPM (requests per minute) and RAGNEWS_LLM_TPM (tokens per minute)
+    environment variables; leaving them unset means the corresponding rate is not limited.
+    '''
+    rpm = os.environ.get('RAGNEWS_LLM_RPM')
+    tpm = os.environ.get('RAGNEWS_LLM_TPM')
+    return LLMScheduler(
+        requests_per_minute=float(rpm) if rpm else None,
+        tokens_per_minute=float(tpm) if tpm else None,
+        )
+
+
+llm_scheduler = _make_llm_scheduler()
+
+
+def run_llm(system, user, model='llama-3.1-70b-versatile', seed=None, use_cache=True, priority='interactive'):
+    '''
+    This is a helper function for all the uses of LLMs in ragnews.
+    The request is sent to the backend returned by get_backend
+    once llm_scheduler allows it (see LLMScheduler);
+    priority should be 'background' for requests that no user is waiting for.
+
+    Responses are stored in llm_cache,
+    and identical calls are answered from the cache without contacting the LLM.
+    Set use_cache=False to bypass the cache (e.g. to get a fresh response for an unseeded call).
+    '''
+    temperature = .5
+    backend = get_backend()
+    key = LLMCache.key(backend.name, model, system, user, seed, temperature)
+    use_cache = use_cache and llm_cache.enabled
+    if use_cache:
+        response = llm_cache.get(key)
+        if response is not None:
+            metrics.inc('ragnews_llm_requests_total', backend=backend.name, cache='hit')
+            return response
+
+    def request():
+        metrics.inc('ragnews_llm_requests_total', backend=backend.name, cache='miss')
+        with metrics.timer('ragnews_llm_request_seconds', backend=backend.name):
+            return backend.complete(system, user, model, seed, temperature)
+
+    tokens = _estimate_tokens(system) + _estimate_tokens(user)
+    try:
+        response = llm_scheduler.submit(request, tokens, priority=priority, key=key)
+    except Exception as e:
+        metrics.inc('ragnews_errors_total', where='llm', type=type(e).__name__)
+        raise
+
+    if use_cache:
+        llm_cache.put(key, response)
+    return response
+
+
+def run_llm_stream(system, user, model='llama-3.1-70b-versatile', seed=None, use_cache=True, priority='interactive'):
+    '''
+    Like run_llm, but returns a generator that yields pieces of the response as soon as the LLM generates them.
+    Cached responses are yielded all at once,
+    and a response is only added to the cache once it has been completely received.
+    '''
+    temperature = .5
+    backend = get_backend()
+    use_cache = use_cache and llm_cache.enabled
+    if use_cache:
+        key = LLMCache.key(backend.name, model, system, user, seed, temperature)
+        response = llm_cache.get(key)
+        if response is not None:
+            metrics.inc('ragnews_llm_requests_total', backend=backend.name, cache='hit')
+            yield response
+            return
+
+    # the request only goes through the scheduler until the first chunk arrives,
+    # because rate limit errors are reported before anything is streamed
+    def request():
+        metrics.inc('ragnews_llm_requests_total', backend=backend.name, cache='miss')
+        stream = backend.stream(system, user, model, seed, temperature)
+        return stream, next(stream, None)
+
+    chunks = []
+    start = time.perf_counter()
+    try:
+        stream, first = llm_scheduler.submit(request, _estimate_tokens(system) + _estimate_tokens(user), priority=priority)
+        if first is not None:
+            chunks.append(first)
+            yield first
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        metrics.observe('ragnews_llm_request_seconds', time.perf_counter() - start, backend=backend.name)
+        llm_scheduler.charge(_estimate_tokens(''.join(chunks)))
+    except Exception as e:
+        metrics.inc('ragnews_errors_total', where='llm', type=type(e).__name__)
+        raise
+
+    if use_cache:
+        llm_cache.put(key, ''.join(chunks))
+
+
+def _estimate_tokens(text):
+    '''
+    Estimate the number of LLM tokens in text without loading a tokenizer.
+    Llama-style tokenizers produce roughly 4 tokens for every 3 words or punctuation marks of English text.
+
+    >>> _estimate_tokens('Harris accepted the nomination.')
+    7
+    '''
+    return len(re.findall(r'\w+|[^\w\s]', text)) * 4 // 3 + 1
+
+
+################################################################################
+# text processing
+################################################################################
+
+CHUNK_CHARS = 8000
+
+# the chunks of every article being translated or summarized share one pool of threads,
+# so a crawl with many workers does not start a new pool (and a burst of LLM calls) per article
+CHUNK_WORKERS = 8
+
+# summaries of summaries shrink the text about 8 times per round,
+# so 3 rounds are enough for texts of several megabytes
+MAX_REDUCE_ROUNDS = 3
+
+_chunk_pool = None
+_chunk_pool_lock = threading.Lock()
+
+
+def _split_text(text, max_chars=CHUNK_CHARS):
+    r'''
+    Split text into chunks of at most max_chars characters.
+    Chunks are split at paragraph boundaries when possible, then at sentence boundaries,
+    and only as a last resort in the middle of a sentence.
+
+    >>> _split_text('aaa bbb.\n\nccc ddd. eee fff.', max_chars=10)
+    ['aaa bbb.', 'ccc ddd.', 'eee fff.']
+    >>> _split_text('abcdefghij', max_chars=4)
+    ['abcd', 'efgh', 'ij']
+    '''
+    if len(text) <= max_chars:
+        return [text]
+    for separator in [r'\n\s*\n', r'\n', r'(?<=[.!?。！？])\s*']:
+        pieces = [piece for piece in re.split(separator, text) if piece.strip()]
+        if len(pieces) > 1:
+            break
+    else:
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+    chunks = []
+    chunk = ''
+    for piece in pieces:
+        if len(piece) > max_chars:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ''
+            chunks.extend(_split_text(piece, max_chars))
+        elif chunk and len(chunk) + 1 + len(piece) > max_chars:
+            chunks.append(chunk)
+            chunk = piece
+        else:
+            chunk = f'{chunk}\n{piece}' if chunk else piece
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _map_chunks(func, chunks):
+    '''
+    Apply func to every chunk concurrently, returning the results in order.
+    The calls run on a thread pool of CHUNK_WORKERS threads that is shared by all callers.
+    func must not call _map_chunks itself, or it could wait forever for a thread of the pool.
+    '''
+    global _chunk_pool
+    if len(chunks) == 1:
+        return [func(chunks[0])]
+    with _chunk_pool_lock:
+        if _chunk_pool is None:
+            _chunk_pool = ThreadPoolExecutor(CHUNK_WORKERS, thread_name_prefix='chunk')
+    return list(_chunk_pool.map(func, chunks))
+
+
+def summarize_text(text, seed=None, max_rounds=MAX_REDUCE_ROUNDS):
+    '''
+    Summarize text into a single English paragraph.
+
+    Long texts are summarized with a map-reduce:
+    the text is split into chunks that are summarized concurrently,
+    and then the chunk summaries are summarized together.
+    So the wall time grows with the number of reduce rounds instead of the length of the text.
+    At most max_rounds reduce rounds are run;
+    if the summaries are still longer than one chunk after that (e.g. because the LLM does not shorten them),
+    only their first chunk is summarized.
+    '''
+    system = 'Summarize the input text below.  Limit the summary to 1 paragraph.  Use an advanced reading level similar to the input text, and ensure that all people, places, and other proper and dates nouns are included in the summary.  The summary should be in English.'
+    chunks = _split_text(text)
+    if len(chunks) == 1 or max_rounds <= 0:
+        return run_llm(system, chunks[0], seed=seed, priority='background')
+    summaries = _map_chunks(lambda chunk: run_llm(system, chunk, seed=seed, priority='background'), chunks)
+    return summarize_text('\n\n'.join(summaries), seed=seed, max_rounds=max_rounds - 1)
+
+
+def translate_text(text):
+    '''
+    Translate text into English.
+    Long texts are split into chunks that are translated concurrently.
+    '''
+    system = 'You are a professional translator working for the United Nations.  The following document is an important news article that needs to be translated into English.  Provide a professional translation.'
+    chunks = _split_text(text)
+    return '\n\n'.join(_map_chunks(lambda chunk: run_llm(system, chunk, priority='background'), chunks))
+
+
+def extract_keywords(text, seed=None):
+    r'''
+    This is a helper function for RAG.
+    Given an input text,
+    this function extracts the keywords that will be used to perform the search for articles that will be used in RAG.
+
+    >>> extract_keywords('Who is the current democratic presidential nominee?', seed=0)
+    'Joe candidate nominee presidential Democrat election primary TBD voting politics'
+    >>> extract_keywords('What is the policy position of Trump related to illegal Mexican immigrants?', seed=0)
+    'Trump Mexican immigrants policy position illegal border control deportation walls'
+
+    Note that the examples above are passing in a seed value for deterministic results.
+    In production, you probably do not want to specify the seed.
+    '''
+
+    system = '''
+    You are an advanced assistant specializing in text analysis. 
+    Your task is to extract the most important and relevant keywords from the following text.  
+    The keywords should capture the core topics and entities mentioned in the text.
+    Responses should come in the format of 'keyword keyword keyword keyword'. 
+    Output exactly 10 keywords. 
+    Output only keywords, nothing more. 
+    Do not prefice the keywords with "here are the keywords," and do not explain how the keywords were found or what their sources are.
+    '''
+  
+    return run_llm(system, text, seed=seed)
+
+    # FIXME:
+    # Implement this function.
+    # It's okay if you don't get the exact same keywords as me.
+    # You probably certainly won't because you probably won't come up with the exact same prompt as me.
+    # To make the test cases above pass,
+    # you'll have to modify them to be what the output of your prompt provides.
+
+
+################################################################################
+# http
+################################################################################
+
+_thread_local = threading.local()
+
+
+def _get_session():
+    '''
+    Return a requests.Session for the current thread.
+
+    Sessions keep a pool of open connections,
+    so repeated downloads from the same hostname do not pay for a new TCP/TLS handshake each time.
+    Sessions are not safe to share between threads, so each thread gets its own.
+    '''
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_local.session = session
+    return session
@@ -0,0 +1,168 @@
+'''
+Counters and latency histograms for the stages of crawling, retrieval, and LLM calls, and a cProfile helper.
+
+The metrics object is updated throughout ragnews,
+and is exported by the /metrics endpoint of ragnews.server and by the --metrics flag of the command line interface.
+'''
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+
+class Metrics:
+    '''
+    Thread-safe counters and latency histograms for the stages of crawling, retrieval, and LLM calls.
+
+    Every metric has a name and optional labels (keyword arguments),
+    following the conventions of Prometheus.
+    The module level metrics object is updated throughout ragnews,
+    and can be exported with to_prometheus (e.g. by the /metrics endpoint of ragnews.server)
+    or to_dict (e.g. by the --metrics flag).
+
+    >>> m = Metrics()
+    >>> m.inc('ragnews_errors_total', where='add_url', type='ValueError')
+    >>> m.observe('ragnews_http_request_seconds', 0.3)
+    >>> m.to_dict()['counters']
+    {'ragnews_errors_total{type="ValueError",where="add_url"}': 1}
+    >>> m.to_dict()['histograms']['ragnews_http_request_seconds']['count']
+    1
+    '''
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Add value to the counter name.
+        '''
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Record one measurement of seconds in the histogram name.
+        '''
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+        A context manager that records the time spent inside of it in the histogram name.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _format(name, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def to_dict(self):
+        '''
+        Return the current values of all metrics as a JSON serializable dictionary.
+        '''
+        with self.lock:
+            return {
+                'counters': {self._format(name, labels): value for (name, labels), value in sorted(self.counters.items())},
+                'histograms': {
+                    self._format(name, labels): {
+                        'count': histogram['count'],
+                        'sum': histogram['sum'],
+                        'mean': histogram['sum'] / histogram['count'],
+                        'buckets': dict(zip(map(str, self.BUCKETS), histogram['buckets'])),
+                        }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                    },
+                }
+
+    def to_prometheus(self):
+        '''
+        Return the current values of all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        typed = set()
+        with self.lock:
+            for name, labels in sorted(self.counters):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{self._format(name, labels)} {self.counters[name, labels]}')
+            for name, labels in sorted(self.histograms):
+                histogram = self.histograms[name, labels]
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append(f'{self._format(name + "_bucket", labels, [("le", bound)])} {count}')
+                lines.append(f'{self._format(name + "_bucket", labels, [("le", "+Inf")])} {histogram["count"]}')
+                lines.append(f'{self._format(name + "_sum", labels)} {histogram["sum"]}')
+                lines.append(f'{self._format(name + "_count", labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        '''
+        Write the metrics to filename, as JSON if it ends in .json and in the Prometheus format otherwise.
+        '''
+        with open(filename, 'w') as fout:
+            if filename.endswith('.json'):
+                json.dump(self.to_dict(), fout, indent=2)
+            else:
+                fout.write(self.to_prometheus())
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def profiled(output=None, limit=25):
+    '''
+    A context manager that runs the code inside of it under cProfile.
+
+    If output is given the profile is saved there (for use with pstats or snakeviz);
+    otherwise the limit functions with the highest cumulative time are printed to stderr.
+    This is intended for investigating a single slow query (see the --profile flag).
+    '''
+    import cProfile
+    import pstats
+    import sys
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output is not None:
+            profiler.dump_stats(output)
+            logging.info(f'profile saved to {output}')
+        else:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(limit)
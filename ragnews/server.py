@@ -0,0 +1,195 @@
+'''
+A long-lived HTTP server for querying a ragnews database.
+
+Run it with:
+
+    $ python3 -m ragnews serve --db=ragnews.db --port=8000
+
+The server provides the following endpoints:
+
+    GET /search?q=QUERY&limit=10    retrieval only; returns the matching articles
+    GET /rag?q=QUERY                 retrieval augmented generation; returns the LLM's answer
+    GET /health                      returns {"status": "ok"}
+    GET /stats                       returns the hit rates of the rag and LLM caches
+    GET /metrics                     returns the timing, token, and error metrics in the Prometheus text format
+
+The /search and /rag endpoints also accept POST requests with a JSON body like {"q": QUERY, "limit": 10}.
+Every response includes the number of seconds spent in each stage of handling the request.
+
+Requests are handled by an asyncio event loop,
+and the (blocking) retrieval and LLM work runs on a thread pool using a pool of read-only sqlite connections.
+Because the database is in WAL mode, queries are not blocked while a crawl is writing new articles.
+If --db is a directory of shards (see ragnews.ShardedArticleDB), every query searches all of the shards in parallel.
+'''
+
+import ragnews
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+    }
+
+
+class RAGServer:
+    '''
+    Answers /search and /rag requests using a pool of read-only connections to the database in filename.
+    '''
+
+    def __init__(self, filename, pool_size=4):
+        if os.path.isdir(filename):
+            self.pool = ragnews.ShardedArticleDB(filename, readonly=True)
+        else:
+            self.pool = ragnews.ArticleDBPool(filename, size=pool_size)
+        self.executor = ThreadPoolExecutor(pool_size, thread_name_prefix='server')
+
+    def search(self, params):
+        '''
+        Return the articles matching params['q'] without calling the LLM.
+        '''
+        timings = {}
+        start = time.perf_counter()
+        with self.pool.connection() as db:
+            timings['queue'] = time.perf_counter() - start
+            start = time.perf_counter()
+            articles = db.find_articles(params['q'], limit=int(params.get('limit', 10)))
+            timings['retrieval'] = time.perf_counter() - start
+        fields = ['url', 'title', 'publish_date', 'en_summary', 'score']
+        return {
+            'articles': [{field: article[field] for field in fields} for article in articles],
+            'timings': timings,
+            }
+
+    def rag(self, params):
+        '''
+        Return the LLM's answer to params['q'].
+        '''
+        timings = {}
+        start = time.perf_counter()
+        with self.pool.connection() as db:
+            timings['queue'] = time.perf_counter() - start
+            answer = ragnews.rag(params['q'], db, timings=timings)
+        return {
+            'answer': answer,
+            'timings': timings,
+            }
+
+    async def handle(self, reader, writer):
+        '''
+        Handle a single HTTP/1.1 connection (one request per connection).
+        '''
+        start = time.perf_counter()
+        method = path = None
+        try:
+            status, payload = await self._dispatch(reader)
+        except (ValueError, KeyError, json.JSONDecodeError) as e:
+            status, payload = 400, {'error': f'bad request: {e}'}
+        except Exception as e:
+            logger.exception('error handling request')
+            ragnews.metrics.inc('ragnews_errors_total', where='server', type=type(e).__name__)
+            status, payload = 500, {'error': str(e)}
+
+        if isinstance(payload, str):
+            content_type = 'text/plain; version=0.0.4'
+            body = payload.encode('utf-8')
+            payload = {}
+        else:
+            if 'timings' in payload:
+                payload['timings']['total'] = time.perf_counter() - start
+                ragnews.metrics.observe('ragnews_server_request_seconds', payload['timings']['total'])
+            content_type = 'application/json'
+            body = json.dumps(payload).encode('utf-8')
+        writer.write(
+            f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n'
+            f'\r\n'.encode('latin-1') + body
+            )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        logger.info(f'{status} {json.dumps(payload.get("timings", {}))}')
+
+    async def _dispatch(self, reader):
+        request_line = (await reader.readline()).decode('latin-1')
+        method, target, _ = request_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ['\r\n', '\n', '']:
+                break
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if method == 'POST':
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if body:
+                params.update(json.loads(body))
+        elif method != 'GET':
+            return 405, {'error': f'unsupported method {method}'}
+
+        handlers = {
+            '/search': self.search,
+            '/rag': self.rag,
+            }
+        if url.path == '/health':
+            return 200, {'status': 'ok'}
+        if url.path == '/metrics':
+            return 200, ragnews.metrics.to_prometheus()
+        if url.path == '/stats':
+            return 200, {'rag_cache': ragnews.rag_cache.stats(), 'llm_cache': ragnews.llm_cache.stats()}
+        if url.path not in handlers:
+            return 404, {'error': f'unknown path {url.path}'}
+        if not params.get('q'):
+            return 400, {'error': 'missing q parameter'}
+        loop = asyncio.get_running_loop()
+        return 200, await loop.run_in_executor(self.executor, handlers[url.path], params)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'serving on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loglevel', default='info')
+    parser.add_argument('--db', default='ragnews.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--pool_size', default=4, type=int, help='Number of read-only database connections (and so the number of requests processed concurrently).')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=args.loglevel.upper(),
+        )
+
+    server = RAGServer(args.db, pool_size=args.pool_size)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
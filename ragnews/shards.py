@@ -0,0 +1,373 @@
+'''
+A database of news articles split across several sqlite files (shards), see ShardedArticleDB.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, quote
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import re
+import sqlite3
+import threading
+import zlib
+import os
+
+from . import ArticleDB, _idf, _normalize_url, _reciprocal_rank_fusion
+
+
+class _Shard:
+    '''
+    One ArticleDB file of a ShardedArticleDB.
+
+    Writes go through the writer connection and queries through the read-only reader connection,
+    so that searching a shard never waits for a batch of inserts into it to commit.
+    Frozen shards have no writer and their reader is memory mapped.
+    '''
+
+    def __init__(self, filename, frozen=False, mmap_size=None):
+        self.filename = filename
+        self.frozen = frozen
+        self.writer = None
+        self.write_lock = threading.Lock()
+        if not frozen:
+            self.writer = ArticleDB(filename, check_same_thread=False)
+        self.reader = ArticleDB(filename, readonly=True, mmap_size=mmap_size if frozen else None)
+        self.read_lock = threading.Lock()
+
+    def read(self, method, *args):
+        with self.read_lock:
+            return getattr(self.reader, method)(*args)
+
+    def write(self, method, *args):
+        with self.write_lock:
+            return getattr(self.writer, method)(*args)
+
+    def close(self):
+        for db in [self.writer, self.reader]:
+            if db is not None:
+                db.db.close()
+
+
+class _ShardedBatchWriter:
+    '''
+    Buffers rows for the ShardedArticleDB.batch method.
+    Each shard has its own buffer, and full buffers are written on the ShardedArticleDB's thread pool,
+    so that inserts into different shards run in parallel.
+    '''
+
+    def __init__(self, sharded, batch_size):
+        self.sharded = sharded
+        self.batch_size = batch_size
+        self.rows = {}
+        self.pending = {}
+        self.count = 0
+
+    def add(self, row):
+        shard = self.sharded._shard_for_row(row)
+        if shard is None:
+            return
+        rows = self.rows.setdefault(shard, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self._flush_shard(shard)
+
+    def _flush_shard(self, shard):
+        rows = self.rows.pop(shard, [])
+        if not rows:
+            return
+        # at most one write per shard is in flight, so the rows of a shard are committed in order
+        if shard in self.pending:
+            self.pending.pop(shard).result()
+        self.pending[shard] = self.sharded.executor.submit(shard.write, 'add_articles', rows, len(rows))
+        self.count += len(rows)
+
+    def flush(self):
+        for shard in list(self.rows):
+            self._flush_shard(shard)
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.result()
+
+
+class ShardedArticleDB:
+    '''
+    A database of news articles split across several ArticleDB files (shards) stored in a directory.
+    It supports the same methods as ArticleDB, so it can be used in place of one (e.g. with rag, crawl, or ragnews.ingest).
+
+    The shard_by parameter controls how articles are partitioned:
+    'hostname' hashes the article's hostname into one of num_shards shards,
+    while 'month' and 'year' put the articles published in each month/year into their own shard
+    (articles without a publication date go into the 'undated' shard).
+    These settings are stored in the directory when it is created, and reused when it is opened again.
+
+    Every article is written to exactly one shard,
+    and each shard has its own sqlite file, so writes to different shards do not block each other.
+    Searches query all of the shards in parallel on a thread pool of the given number of workers
+    and merge the results (see find_articles).
+
+    Time shards whose key sorts before frozen_before (e.g. '2024-01') are frozen:
+    they are opened read-only with up to mmap_size bytes memory mapped,
+    and rows that would be written to them are dropped with a warning.
+    If readonly is True, then every shard is opened read-only (as in ArticleDBPool).
+    '''
+
+    SHARD_BY = ['hostname', 'month', 'year']
+
+    def __init__(self, directory, shard_by='hostname', num_shards=8, readonly=False, frozen_before=None, mmap_size=2**30, workers=None):
+        config_path = os.path.join(directory, 'shards.json')
+        if os.path.exists(config_path):
+            with open(config_path) as fin:
+                config = json.load(fin)
+        else:
+            if shard_by not in self.SHARD_BY:
+                raise ValueError(f'unknown shard_by {shard_by!r}; expected one of {self.SHARD_BY}')
+            config = {'shard_by': shard_by, 'num_shards': num_shards}
+            os.makedirs(directory, exist_ok=True)
+            with open(config_path, 'w') as fout:
+                json.dump(config, fout)
+        self.directory = directory
+        self.shard_by = config['shard_by']
+        self.num_shards = config['num_shards']
+        self.readonly = readonly
+        self.frozen_before = frozen_before
+        self.mmap_size = mmap_size
+        self.cache_id = os.path.abspath(directory)
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count(), thread_name_prefix='shard')
+        self._lock = threading.Lock()
+        self.shards = {}
+        self._listed_mtime = None
+        self._all_shards()
+
+    def _shard_key(self, url, publish_date=None):
+        '''
+        Return the name of the shard that the article with the given url and publish_date belongs to.
+        '''
+        if self.shard_by == 'hostname':
+            hostname = urlparse(_normalize_url(url)).netloc
+            return f'host-{zlib.crc32(hostname.encode("utf-8")) % self.num_shards:02d}'
+        match = re.match(r'(\d{4})-(\d{2})', publish_date or '')
+        if match is None:
+            return 'undated'
+        if self.shard_by == 'year':
+            return match.group(1)
+        return f'{match.group(1)}-{match.group(2)}'
+
+    def _is_frozen(self, key):
+        return self.readonly or (
+            self.frozen_before is not None
+            and self.shard_by != 'hostname'
+            and key != 'undated'
+            and key < self.frozen_before
+            )
+
+    def _get_shard(self, key, create=False):
+        '''
+        Return the shard named key, opening it if needed.
+        Returns None if the shard does not exist and create is False.
+        '''
+        with self._lock:
+            if key not in self.shards:
+                filename = os.path.join(self.directory, key + '.db')
+                if not os.path.exists(filename) and not create:
+                    return None
+                self.shards[key] = _Shard(filename, frozen=self._is_frozen(key), mmap_size=self.mmap_size)
+            return self.shards[key]
+
+    def _all_shards(self):
+        '''
+        Return every shard in the directory.
+
+        Other processes (e.g. a crawl writing to a directory that ragnews.server is reading)
+        may create new shards at any time,
+        so the directory is listed again whenever its modification time changes.
+        A new shard is only opened once its schema has been created.
+
+        >>> import tempfile
+        >>> directory = os.path.join(tempfile.mkdtemp(), 'shards')
+        >>> writer = ShardedArticleDB(directory, shard_by='year')
+        >>> row = dict.fromkeys(['hostname', 'crawl_date', 'lang', 'en_translation', 'en_summary'])
+        >>> row.update(title='Harris accepts the nomination', text='Harris accepts the democratic nomination in Chicago.')
+        >>> writer.add_articles([dict(row, url='https://a.com/1', publish_date='2024-08-22')])
+        1
+        >>> reader = ShardedArticleDB(directory, readonly=True)
+        >>> len(reader), reader.corpus_version()
+        (1, 1)
+        >>> writer.add_articles([dict(row, url='https://a.com/2', publish_date='2020-08-20')])
+        1
+        >>> len(reader), reader.corpus_version()
+        (2, 2)
+        >>> sorted(article['url'] for article in reader.find_articles('Harris nomination'))
+        ['https://a.com/1', 'https://a.com/2']
+        '''
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime != self._listed_mtime:
+            self._listed_mtime = mtime
+            for filename in sorted(os.listdir(self.directory)):
+                if not filename.endswith('.db'):
+                    continue
+                if self._has_schema(os.path.join(self.directory, filename)):
+                    self._get_shard(filename[:-len('.db')])
+                else:
+                    # creating the schema does not change the directory, so check again next time
+                    self._listed_mtime = None
+        with self._lock:
+            return list(self.shards.values())
+
+    def _has_schema(self, filename):
+        '''
+        Return True if the shard file has been opened and migrated by a writer at least once.
+        '''
+        if filename in (shard.filename for shard in list(self.shards.values())):
+            return True
+        uri = 'file:' + quote(os.path.abspath(filename)) + '?mode=ro'
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            return db.execute('PRAGMA user_version;').fetchone()[0] > 0
+        except sqlite3.Error:
+            return False
+        finally:
+            db.close()
+
+    def _shard_for_row(self, row):
+        '''
+        Return the shard that row should be written to, or None if that shard is frozen.
+        '''
+        key = self._shard_key(row['url'], row.get('publish_date'))
+        if self._is_frozen(key):
+            logging.warning(f'shard {key} is read-only; not writing {row["url"]}')
+            return None
+        return self._get_shard(key, create=True)
+
+    def _find_shard(self, url):
+        '''
+        Return the shard that contains url, or None.
+        With hostname sharding the shard is computed from the url;
+        with time sharding every shard has to be checked.
+        '''
+        if self.shard_by == 'hostname':
+            shard = self._get_shard(self._shard_key(url))
+            if shard is not None and shard.read('_is_dupe', url):
+                return shard
+            return None
+        for shard in self._all_shards():
+            if shard.read('_is_dupe', url):
+                return shard
+        return None
+
+    def _map(self, method, *args):
+        '''
+        Call the read-only method on every shard in parallel and return the list of results.
+        '''
+        futures = [self.executor.submit(shard.read, method, *args) for shard in self._all_shards()]
+        return [future.result() for future in futures]
+
+    def find_articles(self, query, limit=10, timebias_alpha=1):
+        '''
+        Return a list of articles in any of the shards that match the specified query
+        (see ArticleDB.find_articles for the meaning of the parameters).
+
+        Every shard is searched in parallel for the same number of candidates that ArticleDB.find_articles considers.
+        The fused score of each shard is based on ranks within that shard,
+        so it cannot be compared between shards (every shard has a best article).
+        Instead, the candidates from all shards are ranked together by their BM25 scores and by their cosine similarities,
+        which are on the same scale in every shard,
+        and those two global rankings are fused again to select the overall top limit articles.
+        This returns nearly the same articles as searching a single ArticleDB containing every article.
+        '''
+        num_candidates = max(50, 5 * limit)
+        results = self._map('find_articles', query, num_candidates, timebias_alpha)
+        candidates = list(itertools.chain.from_iterable(results))
+        bm25 = [i for i, article in enumerate(candidates) if article['bm25'] is not None]
+        bm25.sort(key=lambda i: candidates[i]['bm25'])
+        dense = [i for i, article in enumerate(candidates) if article['similarity'] is not None]
+        dense.sort(key=lambda i: -candidates[i]['similarity'])
+        fused = _reciprocal_rank_fusion([bm25[:num_candidates], dense[:num_candidates]])[:limit]
+        return [dict(candidates[i], score=score) for i, score in fused]
+
+    def term_idf(self, terms):
+        '''
+        Return the inverse document frequencies of terms over all of the shards (see ArticleDB.term_idf).
+        '''
+        doc_freqs = collections.Counter()
+        for shard_doc_freqs in self._map('_doc_freqs', terms):
+            doc_freqs.update(shard_doc_freqs)
+        return _idf(doc_freqs, len(self))
+
+    def corpus_version(self):
+        '''
+        Return a number that increases every time articles are added to any shard.
+        '''
+        return sum(self._map('corpus_version'))
+
+    def __len__(self):
+        return sum(self._map('__len__'))
+
+    def _is_dupe(self, url):
+        return self._find_shard(url) is not None
+
+    def _get_validators(self, url):
+        shard = self._find_shard(url)
+        if shard is None:
+            return None
+        return shard.read('_get_validators', url)
+
+    def _is_unchanged(self, page, validators):
+        if validators is None:
+            return False
+        shard = self._find_shard(page['url'])
+        if shard is None:
+            return False
+        if shard.frozen:
+            # frozen shards cannot be updated, so there is no point in processing their pages again
+            return True
+        return shard.write('_is_unchanged', page, validators)
+
+    @contextlib.contextmanager
+    def batch(self, batch_size=100, optimize=False):
+        '''
+        A context manager that buffers inserts into the shards (see ArticleDB.batch).
+        '''
+        writer = _ShardedBatchWriter(self, batch_size)
+        try:
+            yield writer
+        finally:
+            writer.flush()
+            if optimize:
+                self.optimize()
+
+    def optimize(self):
+        '''
+        Merge the FTS5 index segments of every writable shard in parallel.
+        '''
+        futures = [self.executor.submit(shard.write, 'optimize') for shard in self._all_shards() if not shard.frozen]
+        for future in futures:
+            future.result()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Return self, so that a read-only ShardedArticleDB can be used in place of an ArticleDBPool (e.g. by ragnews.server).
+        All of its methods can be called from several threads at once.
+        '''
+        yield self
+
+    def close(self):
+        self.executor.shutdown()
+        for shard in self._all_shards():
+            shard.close()
+
+    add_url = ArticleDB.add_url
+    crawl = ArticleDB.crawl
+    add_articles = ArticleDB.add_articles
+
+
+def open_db(path, readonly=False, shard_by=None):
+    '''
+    Open path as a ShardedArticleDB if it is a directory (or shard_by is given), and as an ArticleDB otherwise.
+    '''
+    if shard_by is not None or os.path.isdir(path):
+        return ShardedArticleDB(path, shard_by=shard_by or 'hostname', readonly=readonly)
+    return ArticleDB(path, readonly=readonly)
@@ -13,8 +13,7 @@ https://www.pitzer.edu/news
 https://www.cgu.edu/news/
 '
 
-for url in $urls; do
-    echo url
-    python3 ragnews.py --add_url="$url" --recursive_depth=5 --db=claremont.db --loglevel=INFO
-done
+# all of the urls are crawled by a single process,
+# so the startup cost is only paid once and the downloads of different sites overlap
+python3 ragnews.py --recursive_depth=5 --workers=8 --db=claremont.db --loglevel=INFO --add_url $urls
 
@@ -126,7 +126,6 @@ https://www.washingtonpost.com/elections/election-2024/
 https://www.usnews.com/topics/subjects/elections
 '
 
-for url in $urls; do
-    echo url
-    python3 ragnews.py --add_url="$url" --recursive_depth=1 --loglevel=DEBUG
-done
+# all of the urls are crawled by a single process,
+# so the startup cost is only paid once and the downloads of different sites overlap
+python3 ragnews.py --recursive_depth=1 --workers=8 --refresh --loglevel=DEBUG --add_url $urls